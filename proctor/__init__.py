@@ -11,4 +11,7 @@ __email__ = 'ncadou@cadou.ca'
 __status__ = 'Development'
 __url__ = 'http://ajah.ca'
 
-__all__ = ['proxy', 'scripts', 'socket', 'tor']
+__all__ = ['accesslog', 'affinity', 'autoscale', 'bench', 'bulk', 'client',
+           'dircache', 'fairshare', 'health', 'interceptors', 'profiling',
+           'proxy', 'ratelimit', 'relay', 'scheduler', 'scripts', 'simulator',
+           'socket', 'tls', 'tor']
@@ -0,0 +1,108 @@
+""" A structured access log, written in the background.
+
+Each request handled by the proxy becomes one JSON object per line, holding
+the Tor instance used, the destination, the response status and size, and
+the time spent in each stage of the request.
+
+"""
+import json
+import logging
+import os
+from os import path
+from Queue import Empty, Full, Queue
+from threading import Event, Thread
+
+log = logging.getLogger(__name__)
+
+
+class AccessLog(Thread):
+    """ Writes access log records to a file from a background thread.
+
+    Records are put in a bounded queue, and dropped when it is full rather
+    than making the request wait, so that the request path never blocks on
+    disk. They are written in batches of up to `batch_size` records, at
+    least every `flush_interval` seconds.
+
+    Once the file exceeds `max_bytes` it is rotated like with
+    logging.handlers.RotatingFileHandler, keeping `backup_count` old files
+    (suffixed .1, .2...).
+
+    """
+    def __init__(self, filename, max_bytes=100 * 1024 * 1024, backup_count=5,
+                 queue_size=10000, batch_size=500, flush_interval=1):
+        super(AccessLog, self).__init__(name='access-log')
+        self.daemon = True
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self._queue = Queue(queue_size)
+        self._stoprequest = Event()
+        self._file = None
+
+    def log(self, record):
+        """ Queue a record (a dict) for writing, without blocking. """
+        try:
+            self._queue.put_nowait(record)
+        except Full:
+            self.dropped += 1  # Not exact, but never blocks either.
+
+    def run(self):
+        self._open()
+        try:
+            while not (self._stoprequest.is_set() and self._queue.empty()):
+                batch = self._get_batch()
+                if batch:
+                    self._write(batch)
+        finally:
+            self._file.close()
+            if self.dropped:
+                log.warn('%d access log records dropped (queue full)'
+                         % self.dropped)
+
+    def stop(self):
+        """ Signal the thread to stop itself once the queue is written. """
+        self._stoprequest.set()
+
+    def _get_batch(self):
+        try:
+            batch = [self._queue.get(timeout=self.flush_interval)]
+        except Empty:
+            return None
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        lines = [json.dumps(record, sort_keys=True, separators=(',', ':'))
+                 for record in batch]
+        try:
+            self._file.write('\n'.join(lines) + '\n')
+            self._file.flush()
+            if self._file.tell() >= self.max_bytes:
+                self._rotate()
+        except (IOError, OSError), e:
+            log.error('Could not write the access log: %s' % e)
+
+    def _open(self):
+        directory = path.dirname(path.abspath(self.filename))
+        if not path.exists(directory):
+            os.makedirs(directory)
+        self._file = open(self.filename, 'a')
+
+    def _rotate(self):
+        self._file.close()
+        if self.backup_count > 0:
+            for i in range(self.backup_count - 1, 0, -1):
+                name = '%s.%d' % (self.filename, i)
+                if path.exists(name):
+                    os.rename(name, '%s.%d' % (self.filename, i + 1))
+            os.rename(self.filename, self.filename + '.1')
+        else:
+            os.remove(self.filename)
+        self._open()
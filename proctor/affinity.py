@@ -0,0 +1,175 @@
+""" Sticky routing of requests to Tor instances, by consistent hashing.
+
+Some sites tie sessions to the IP address they come from, and round-robin
+over the instances makes the exit change at every request. In affinity mode
+requests carry a key, taken from the destination host, a cookie or a header,
+and each key goes through the same instance as long as it is available.
+
+Keys are placed on a hash ring of instance names. Adding or removing an
+instance only moves the keys it gains or loses, and the keys of an instance
+that is unavailable (restarting, or held back by its health policy) go to
+the next instance on the ring until it is back. Requests only held back by
+a rate limit wait for their turn on their instance instead.
+
+"""
+import hashlib
+import logging
+import struct
+from bisect import bisect
+from collections import defaultdict
+from time import sleep
+
+from proctor.lrucache import LRUCache
+from proctor.scheduler import Scheduler
+
+log = logging.getLogger(__name__)
+
+
+def _hash(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return struct.unpack('>Q', hashlib.md5(value).digest()[:8])[0]
+
+
+def _header(headers, name):
+    """ Return a header from a dict or a mimetools.Message, or None. """
+    name = name.lower()
+    for key, value in headers.items():
+        if key.lower() == name:
+            return value
+    return None
+
+
+class HashRing(object):
+    """ Maps keys to names, each name having `replicas` points on a ring. """
+    def __init__(self, names=(), replicas=160):
+        self.replicas = replicas
+        self.names = frozenset(names)
+        points = sorted((_hash('%s-%d' % (name, i)), name)
+                        for name in self.names for i in range(replicas))
+        self._hashes = [h for h, _ in points]
+        self._names = [name for _, name in points]
+
+    def walk(self, key):
+        """ Yield the names in the order they are tried for a key. """
+        if not self._names:
+            return
+        seen = set()
+        start = bisect(self._hashes, _hash(key))
+        for i in xrange(len(self._names)):
+            name = self._names[(start + i) % len(self._names)]
+            if name not in seen:
+                seen.add(name)
+                yield name
+                if len(seen) == len(self.names):
+                    return
+
+
+class AffinityScheduler(Scheduler):
+    """ A Scheduler sending the requests with the same key to one instance.
+
+    The key of a request is given by `key`: 'host' for its destination
+    host, 'cookie:NAME' for the value of a cookie (per host), or
+    'header:NAME' for the value of a request header. Requests without a
+    key, e.g. lacking the cookie, are spread round-robin.
+
+    The last instance of the `keys_max` most recent keys is remembered, to
+    count the keys that move to another instance (see stats()).
+
+    """
+    def __init__(self, tor_swarm, key='host', replicas=160, keys_max=100000):
+        super(AffinityScheduler, self).__init__(tor_swarm)
+        kind, _, name = key.partition(':')
+        if kind not in ('host', 'cookie', 'header') or (
+                kind != 'host' and not name):
+            raise ValueError('Unknown affinity key: %s' % key)
+        self.key_kind = kind
+        self.key_name = name
+        self.replicas = replicas
+        self._ring = HashRing(replicas=replicas)
+        self._last = LRUCache(keys_max)
+        self._lookups = 0
+        self._failovers = 0
+        self._remaps = defaultdict(int)
+        self._ring_changes = 0
+
+    def request_key(self, hostname, headers):
+        """ Return the affinity key of a request, or None. """
+        if self.key_kind == 'host':
+            return hostname.lower()
+        if self.key_kind == 'header':
+            return _header(headers, self.key_name)
+        for cookie in (_header(headers, 'Cookie') or '').split(';'):
+            name, _, value = cookie.strip().partition('=')
+            if name == self.key_name and value:
+                return '%s|%s' % (hostname.lower(), value)
+        return None
+
+    def _members(self):
+        """ Return the instances by name, updating the ring if needed. """
+        instances = dict((i.name, i) for i in self.tor_swarm.members()
+                         if not i.draining)
+        if self._ring.names != frozenset(instances):
+            with self._lock:
+                if self._ring.names != frozenset(instances):
+                    log.debug('Affinity ring now over %s'
+                              % ', '.join(sorted(instances)))
+                    # Replaced at once, so that it can be read unlocked.
+                    self._ring = HashRing(instances, self.replicas)
+                    self._ring_changes += 1
+        return instances
+
+    def pick(self, accept=None, key=None):
+        """ Return the instance for the key, see Scheduler.pick(). """
+        if key is None:
+            return super(AffinityScheduler, self).pick(accept)
+        waited = False
+        try:
+            while True:
+                instances = self._members()
+                reason = None
+                for rank, name in enumerate(self._ring.walk(key)):
+                    tor_instance = instances.get(name)
+                    # The ring may be for members newer than ours.
+                    if tor_instance is None:
+                        continue
+                    reason = self.refusal(tor_instance, accept)
+                    if reason is None:
+                        self._account(key, name, rank)
+                        return tor_instance
+                    if reason == 'accept':
+                        # Only rate limited: no need to move the key.
+                        break
+                if not waited and reason != 'accept':
+                    waited = True
+                    self._set_waiting(1)
+                sleep(0.05)
+        finally:
+            if waited:
+                self._set_waiting(-1)
+
+    def _account(self, key, name, rank):
+        previous = self._last.get(key)
+        self._last.put(key, name)
+        with self._lock:
+            self._lookups += 1
+            if rank:
+                self._failovers += 1
+            if previous is not None and previous != name:
+                self._remaps[previous] += 1
+
+    def stats(self):
+        """ Return the affinity statistics, as a dict.
+
+        It holds the number of keys remembered, of picks with a key, of
+        those that went to a fallback instance because the first one for
+        the key was unavailable, of ring changes, and the number of keys
+        that moved away from each instance (`remaps`) and in total.
+
+        """
+        with self._lock:
+            return dict(keys=len(self._last), lookups=self._lookups,
+                        failovers=self._failovers,
+                        ring_changes=self._ring_changes,
+                        remaps=dict(self._remaps),
+                        remaps_total=sum(self._remaps.values()))
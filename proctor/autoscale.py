@@ -0,0 +1,113 @@
+""" Resizing of a Tor swarm according to its load. """
+
+import logging
+from datetime import datetime
+from threading import Event, Thread
+
+log = logging.getLogger(__name__)
+
+
+class Autoscaler(Thread):
+    """ Grows and shrinks a TorSwarm between a minimum and a maximum size.
+
+    Every `interval` seconds the load of the swarm is measured as the mean
+    number of open sockets per connected instance. The swarm grows by one
+    instance when requests are waiting for an instance, when the load is
+    above `target_load`, or when the mean connection time is above
+    `latency_high` while the load is above half the target. It shrinks by
+    one instance when the load is below half the target.
+
+    With a `fair_share` (see proctor.fairshare), the requests waiting for
+    their turn there count as waiting for an instance too, as the fair share
+    caps the load of instances below its slots.
+
+    Instances still bootstrapping count as capacity, so the swarm does not
+    grow again before they join. Resizing happens at most once per
+    `cooldown` seconds, and terminated instances are replaced.
+
+    """
+    def __init__(self, tor_swarm, scheduler, min_instances, max_instances,
+                 target_load=8, latency_high=None, interval=5, cooldown=30,
+                 fair_share=None):
+        super(Autoscaler, self).__init__(name='autoscaler')
+        self.daemon = True
+        self.tor_swarm = tor_swarm
+        self.scheduler = scheduler
+        self.min_instances = min_instances
+        self.max_instances = max_instances
+        self.target_load = target_load
+        self.latency_high = latency_high
+        self.interval = interval
+        self.cooldown = cooldown
+        self.fair_share = fair_share
+        self._last_resize = datetime.utcnow()
+        self._stoprequest = Event()
+
+    def run(self):
+        while not self._stoprequest.wait(self.interval):
+            try:
+                self.step()
+            except Exception:
+                log.exception('Autoscaler step failed')
+
+    def stop(self):
+        """ Signal the thread to stop itself. """
+        self._stoprequest.set()
+
+    def step(self):
+        """ Take one scaling decision. """
+        instances = [i for i in self.tor_swarm.members() if not i.draining]
+        for tor in [i for i in instances if i.terminated]:
+            log.info('Removing terminated %s' % tor.name)
+            self.tor_swarm.remove_instance(tor, drain_time_max=0)
+            instances.remove(tor)
+
+        size = len(instances)
+        if size < self.min_instances:
+            self._grow('below minimum size')
+            return
+        if size > self.max_instances:
+            self._shrink(instances, 'above maximum size')
+            return
+        if (datetime.utcnow() - self._last_resize).total_seconds() \
+                < self.cooldown:
+            return
+
+        connected = [i for i in instances if i.connected]
+        booting = size - len(connected)
+        load = (sum(i.active_sockets for i in connected)
+                / float(len(connected) or 1))
+        latency = (sum(i.get_stats()[1] for i in connected)
+                   / float(len(connected) or 1))
+        waiting = self.scheduler.waiting
+        if self.fair_share is not None:
+            waiting += self.fair_share.waiting
+        log.debug('Swarm: %d connected, %d booting, load %.1f, latency '
+                  '%.2fs, %d waiting' % (len(connected), booting, load,
+                                         latency, waiting))
+
+        if size < self.max_instances and not booting:
+            if waiting:
+                return self._grow('%d requests waiting' % waiting)
+            if load > self.target_load:
+                return self._grow('load %.1f' % load)
+            if (self.latency_high and latency > self.latency_high
+                    and load > self.target_load / 2.0):
+                return self._grow('latency %.2fs' % latency)
+        if (size > max(self.min_instances, 1) and not (booting or waiting)
+                and load < self.target_load / 2.0
+                # Would the remaining instances stay below the target?
+                and load * size / (size - 1) < self.target_load):
+            self._shrink(connected, 'load %.1f' % load)
+
+    def _grow(self, reason):
+        tor = self.tor_swarm.add_instance()
+        log.info('Added %s (%s)' % (tor.name, reason))
+        self._last_resize = datetime.utcnow()
+
+    def _shrink(self, candidates, reason):
+        # The least busy instance drains the fastest.
+        tor = min(candidates, key=lambda i: i.active_sockets)
+        log.info('Removing %s (%s)' % (tor.name, reason))
+        self.tor_swarm.remove_instance(tor)
+        self._last_resize = datetime.utcnow()
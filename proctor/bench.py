@@ -0,0 +1,274 @@
+""" Benchmarks of proctor components.
+
+Run with `python -m proctor.bench <benchmark> --help` for the options of
+each benchmark.
+
+"""
+from __future__ import absolute_import
+
+import logging
+import ssl
+import sys
+from argparse import ArgumentParser
+from httplib import HTTPConnection, HTTPSConnection
+from multiprocessing.pool import ThreadPool
+from os import path
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Thread
+from time import sleep, time
+from urlparse import urlparse, urlunparse
+
+from proctor.scripts import LOG_FORMAT
+
+log = logging.getLogger(__name__)
+
+
+def percentiles(samples):
+    """ Return the min, median, 90th percentile and max of samples. """
+    samples = sorted(samples)
+    if not samples:
+        return None
+    last = len(samples) - 1
+    return (samples[0], samples[last // 2], samples[int(last * 0.9)],
+            samples[-1])
+
+
+def report(name, samples):
+    """ Print a line with the distribution of the samples, in ms. """
+    values = percentiles(samples)
+    if values is None:
+        print '%-12s no samples' % name
+        return
+    print ('%-12s n=%-5d min %.3fms  median %.3fms  p90 %.3fms  max %.3fms'
+           % ((name, len(samples)) + tuple(v * 1000 for v in values)))
+
+
+def _wait_connected(instances, timeout):
+    start_time = time()
+    while not all(i.connected for i in instances):
+        if time() - start_time > timeout:
+            raise RuntimeError('Tor instances not connected after %ds'
+                               % timeout)
+        if [i for i in instances if i.terminated]:
+            raise RuntimeError('A Tor instance terminated while booting')
+        sleep(0.25)
+
+
+def _socks_connect(tor, host, port):
+    """ Connect through Tor, and return the time until the SOCKS reply. """
+    sock = tor.create_socket()
+    start_time = time()
+    try:
+        sock.connect((host, port))
+    except Exception:
+        pass  # Refused by Tor, which is what the handshake benchmark wants.
+    elapsed = time() - start_time
+    sock.close()
+    return elapsed
+
+
+def _fetch(tor, host, port, url_path):
+    """ Fetch a page through Tor, and return the time it took. """
+    sock = tor.create_socket()
+    start_time = time()
+    try:
+        sock.connect((host, port))
+        sock.sendall('GET %s HTTP/1.0\r\nHost: %s\r\n\r\n' % (url_path, host))
+        while sock.recv(64 * 1024):
+            pass
+    finally:
+        sock.close()
+    return time() - start_time
+
+
+def bench_transport(args):
+    """ Compare TCP and Unix domain socket transports to Tor. """
+    from proctor.tor import TorProcess
+    work_dir = args.work_dir or mkdtemp()
+    # Refused handshakes count as errors, which must not cause restarts.
+    options = dict(errors_max=sys.maxint, conn_time_avg_max=sys.maxint)
+    instances = dict(
+        tcp=TorProcess('tor-tcp', args.socks_port, args.control_port,
+                       work_dir, **options),
+        unix=TorProcess('tor-unix', args.socks_port + 1,
+                        args.control_port + 1, work_dir, unix_sockets=True,
+                        **options))
+    try:
+        for tor in instances.values():
+            tor.start()
+        _wait_connected(instances.values(), args.boot_timeout)
+        host, _, port = args.target.rpartition(':')
+        samples = dict((name, list()) for name in instances)
+        fetches = dict((name, list()) for name in instances)
+        # Interleaved, so that both transports see the same conditions.
+        for _ in range(args.count):
+            for name, tor in sorted(instances.iteritems()):
+                samples[name].append(_socks_connect(tor, host, int(port)))
+        if args.url_host:
+            for _ in range(args.fetch_count):
+                for name, tor in sorted(instances.iteritems()):
+                    try:
+                        fetches[name].append(
+                            _fetch(tor, args.url_host, 80, args.url_path))
+                    except Exception, e:
+                        log.warn('Fetch through %s failed: %s' % (name, e))
+        print 'SOCKS handshake to %s:' % args.target
+        for name in sorted(samples):
+            report(name, samples[name])
+        if args.url_host:
+            print 'Fetch of http://%s%s:' % (args.url_host, args.url_path)
+            for name in sorted(fetches):
+                report(name, fetches[name])
+    finally:
+        for tor in instances.values():
+            tor.stop()
+            tor.join()
+        if not args.work_dir:
+            rmtree(work_dir)
+
+
+def _fetch_via_proxy(proxy_port, url, timeout=10):
+    """ Fetch a url through the proxy, and return the time it took. """
+    u = urlparse(url)
+    start_time = time()
+    if u.scheme == 'https':
+        # The certificates forged by the proxy cannot be verified.
+        conn = HTTPSConnection('localhost', proxy_port, timeout=timeout,
+                               context=ssl._create_unverified_context())
+        conn.set_tunnel(u.hostname, u.port or 443)
+        url = urlunparse(('', '', u.path or '/', u.params, u.query, ''))
+    else:
+        conn = HTTPConnection('localhost', proxy_port, timeout=timeout)
+    try:
+        conn.request('GET', url)
+        conn.getresponse().read()
+    finally:
+        conn.close()
+    return time() - start_time
+
+
+def _timed_fetches(fetch, urls, concurrency):
+    """ Run fetch on the urls, return the fetch times and the total time. """
+    def timed(url):
+        try:
+            return fetch(url)
+        except Exception, e:
+            log.warn('Fetch of %s failed: %s' % (url, e))
+            return None
+
+    pool = ThreadPool(concurrency)
+    start_time = time()
+    try:
+        samples = pool.map(timed, urls)
+    finally:
+        pool.close()
+        pool.join()
+    return [s for s in samples if s is not None], time() - start_time
+
+
+def bench_client(args):
+    """ Compare the in-process client with going through the proxy. """
+    from proctor.client import TorClient
+    from proctor.proxy import TorMitmProxy, tor_proxy_handler_factory
+    from proctor.tor import TorSwarm
+    work_dir = args.work_dir or mkdtemp()
+    swarm = TorSwarm(args.socks_port, args.control_port, work_dir, None)
+    proxy = None
+    try:
+        _wait_connected(swarm.start(args.instances), args.boot_timeout)
+        handler_factory = tor_proxy_handler_factory(swarm)
+        proxy = TorMitmProxy(server_address=('localhost', args.proxy_port),
+                             RequestHandlerClass=handler_factory,
+                             ca_file=path.join(work_dir, 'ca.pem'),
+                             cert_dir=path.join(work_dir, 'certs'))
+        server = Thread(target=proxy.serve_forever, name='proxy')
+        server.daemon = True
+        server.start()
+        # Both paths share the scheduler, and so the health of instances.
+        client = TorClient(swarm, scheduler=handler_factory.scheduler)
+
+        def via_client(url):
+            return client.get(url).elapsed
+
+        def via_proxy(url):
+            return _fetch_via_proxy(args.proxy_port, url)
+
+        urls = [args.url] * args.count
+        print 'Fetches of %s, %d at a time:' % (args.url, args.concurrency)
+        for name, fetch in (('proxy', via_proxy), ('client', via_client)):
+            samples, elapsed = _timed_fetches(fetch, urls, args.concurrency)
+            report(name, samples)
+            print ('%-12s %.2f fetches/s, %d failed'
+                   % ('', len(samples) / elapsed, args.count - len(samples)))
+    finally:
+        if proxy is not None:
+            proxy.shutdown()
+            proxy.server_close()
+        swarm.stop()
+        if not args.work_dir:
+            rmtree(work_dir)
+
+
+def get_args_parser():
+    parser = ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-l', '--loglevel', default='WARN',
+                        choices=('CRITICAL', 'ERROR', 'WARN', 'INFO', 'DEBUG'),
+                        help='Display messages above this log level')
+    subparsers = parser.add_subparsers(title='benchmarks')
+
+    transport = subparsers.add_parser(
+        'transport', help=bench_transport.__doc__.strip())
+    transport.set_defaults(func=bench_transport)
+    transport.add_argument('-d', '--work-dir', help='Working directory')
+    transport.add_argument('-s', '--socks-port', type=int, default=29050,
+                           help='SOCKS port of the TCP Tor process')
+    transport.add_argument('-c', '--control-port', type=int, default=28118,
+                           help='Control port of the TCP Tor process')
+    transport.add_argument('-n', '--count', type=int, default=1000,
+                           help='Number of SOCKS handshakes per transport')
+    transport.add_argument('--target', default='invalid.onion:80',
+                           help='host:port to connect to; the default is '
+                                'refused by Tor itself, which measures the '
+                                'local round trip only')
+    transport.add_argument('--url-host',
+                           help='Also fetch a page from this host through '
+                                'each transport')
+    transport.add_argument('--url-path', default='/',
+                           help='Path of the page to fetch')
+    transport.add_argument('--fetch-count', type=int, default=20,
+                           help='Number of fetches per transport')
+    transport.add_argument('--boot-timeout', type=int, default=120,
+                           help='Seconds to wait for Tor to bootstrap')
+
+    client = subparsers.add_parser(
+        'client', help=bench_client.__doc__.strip())
+    client.set_defaults(func=bench_client)
+    client.add_argument('url', help='URL to fetch, http or https')
+    client.add_argument('-d', '--work-dir', help='Working directory')
+    client.add_argument('-s', '--socks-port', type=int, default=29050,
+                        help='Base SOCKS port of the Tor processes')
+    client.add_argument('-c', '--control-port', type=int, default=28118,
+                        help='Base control port of the Tor processes')
+    client.add_argument('-p', '--proxy-port', type=int, default=28080,
+                        help='Port of the proxy')
+    client.add_argument('-i', '--instances', type=int, default=2,
+                        help='Number of Tor processes')
+    client.add_argument('-n', '--count', type=int, default=100,
+                        help='Number of fetches through each path')
+    client.add_argument('--concurrency', type=int, default=8,
+                        help='Number of fetches in flight')
+    client.add_argument('--boot-timeout', type=int, default=120,
+                        help='Seconds to wait for Tor to bootstrap')
+    return parser
+
+
+def main(argv=None):
+    args = get_args_parser().parse_args(argv)
+    logging.basicConfig(level=getattr(logging, args.loglevel),
+                        format=LOG_FORMAT)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
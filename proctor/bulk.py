@@ -0,0 +1,295 @@
+""" Fetch long lists of urls through the Tor swarm, straight to disk.
+
+Run with `proctor fetch --output DIR URL_FILE`, or from Python:
+
+    client = TorClient(swarm)
+    bulk_fetch(client, open('urls.txt'), 'results')
+
+Results are appended to DIR/results.jsonl as fetches finish, so their order
+does not follow the input. Running the same job again with the same output
+directory resumes it: urls already fetched are skipped, and those that
+failed are tried again.
+
+"""
+from __future__ import absolute_import
+
+import hashlib
+import json
+import logging
+import os
+import sys
+from argparse import ArgumentParser
+from os import path
+from Queue import Full, Queue
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Event, Lock, Thread
+from time import sleep
+
+from proctor.scripts import (
+    LOG_FORMAT, add_loglevel_argument, add_rate_limit_arguments,
+    add_swarm_arguments, rate_limit_options, swarm_options)
+from proctor.vendor.exit import handle_exit
+
+log = logging.getLogger(__name__)
+
+
+def read_urls(filename):
+    """ Yield the urls of a file, one per line, or of stdin for '-'. """
+    f = sys.stdin if filename == '-' else open(filename)
+    try:
+        for line in f:
+            url = line.strip()
+            if url and not url.startswith('#'):
+                yield url
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def _digest(url):
+    return hashlib.sha1(url).digest()
+
+
+class BulkFetch(object):
+    """ Fetches a stream of urls through a TorClient, `concurrency` at a time.
+
+    Each result is a line of `results.jsonl` in `output_dir`: the url, the
+    response status, reason and headers, its size, the Tor instance used,
+    the time it took and the number of attempts, or the error of the last
+    attempt. Response bodies are written under `bodies/`, named after the
+    SHA-1 of the url (see body_path()), unless `save_bodies` is false.
+
+    Urls that already have a successful result in `output_dir` are skipped;
+    only the digests of those are kept in memory, the urls to fetch are read
+    as they are needed. Urls repeated within a run are fetched each time.
+    Failed fetches are tried again up to `retries` times, each attempt going
+    through the instance the scheduler picks next.
+
+    """
+    results_name = 'results.jsonl'
+    progress_interval = 1000
+
+    def __init__(self, client, output_dir, concurrency=32, retries=2,
+                 save_bodies=True, method='GET'):
+        self.client = client
+        self.output_dir = output_dir
+        self.concurrency = concurrency
+        self.retries = retries
+        self.save_bodies = save_bodies
+        self.method = method
+        self.counts = dict(fetched=0, failed=0, skipped=0)
+        self._results_file = path.join(output_dir, self.results_name)
+        self._done = set()  # Digests of the urls fetched by previous runs.
+        self._queue = Queue(concurrency * 2)
+        self._lock = Lock()
+        self._stoprequest = Event()
+        self._file = None
+
+    def body_path(self, url):
+        """ Return the path where the body fetched from the url is written. """
+        digest = _digest(url).encode('hex')
+        return path.join('bodies', digest[:2], digest)
+
+    def run(self, urls):
+        """ Fetch the urls, an iterable of strings, and return the counts. """
+        if not path.exists(self.output_dir):
+            os.makedirs(self.output_dir)
+        self._load_done()
+        self._file = open(self._results_file, 'a')
+        workers = [Thread(target=self._work, name='fetch-%d' % i)
+                   for i in range(self.concurrency)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        try:
+            for url in urls:
+                if self._stoprequest.is_set():
+                    break
+                if self._done and _digest(url) in self._done:
+                    self.counts['skipped'] += 1
+                    continue
+                self._put(url)
+        except:
+            self.stop()
+            raise
+        finally:
+            for _ in workers:
+                self._put(None, force=True)
+            for worker in workers:
+                worker.join()
+            self._file.close()
+        return self.counts
+
+    def stop(self):
+        """ Stop fetching, the fetches in progress still get their result. """
+        self._stoprequest.set()
+
+    def _load_done(self):
+        """ Read the urls fetched by a previous run of the job. """
+        if not path.exists(self._results_file):
+            return
+        with open(self._results_file, 'r+') as f:
+            end = 0
+            for line in iter(f.readline, ''):
+                if not line.endswith('\n'):
+                    break  # Written in part when the previous run died.
+                end += len(line)
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if 'error' not in record:
+                    self._done.add(_digest(record['url'].encode('latin-1')))
+            f.truncate(end)
+        log.info('Resuming, %d urls already fetched' % len(self._done))
+
+    def _put(self, url, force=False):
+        # With a timeout, waiting does not block signals.
+        while True:
+            try:
+                self._queue.put(url, timeout=1)
+                return
+            except Full:
+                if self._stoprequest.is_set() and not force:
+                    return
+
+    def _work(self):
+        while True:
+            url = self._queue.get()
+            if url is None:
+                return
+            if self._stoprequest.is_set():
+                continue
+            try:
+                self._write(self._fetch(url))
+            except Exception:
+                log.exception('Could not save the result of %s' % url)
+
+    def _fetch(self, url):
+        record = dict(url=url)
+        for attempt in range(1, self.retries + 2):
+            record['attempts'] = attempt
+            try:
+                response = self.client.request(self.method, url)
+            except ValueError, e:
+                record['error'] = str(e)  # Not a url we can fetch.
+                break
+            except Exception, e:
+                record['error'] = str(e) or e.__class__.__name__
+                continue
+            record.pop('error', None)
+            record.update(status=response.status, reason=response.reason,
+                          headers=dict(response.headers.items()),
+                          bytes=len(response.body),
+                          instance=response.instance,
+                          elapsed=round(response.elapsed, 3))
+            if self.save_bodies:
+                record['body'] = self._save_body(url, response.body)
+            break
+        return record
+
+    def _save_body(self, url, body):
+        body_path = self.body_path(url)
+        filename = path.join(self.output_dir, body_path)
+        directory = path.dirname(filename)
+        if not path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass  # Created by another thread in the meantime.
+        with open(filename, 'wb') as f:
+            f.write(body)
+        return body_path
+
+    def _write(self, record):
+        # Urls and headers are byte strings, which need not be UTF-8.
+        line = json.dumps(record, sort_keys=True, separators=(',', ':'),
+                          encoding='latin-1')
+        with self._lock:
+            # The line goes after the body, a result on disk is complete.
+            self._file.write(line + '\n')
+            self._file.flush()
+            self.counts['failed' if 'error' in record else 'fetched'] += 1
+            count = self.counts['fetched'] + self.counts['failed']
+            if count % self.progress_interval == 0:
+                log.info('%(fetched)d urls fetched, %(failed)d failed'
+                         % self.counts)
+
+
+def bulk_fetch(client, urls, output_dir, **kwargs):
+    """ Fetch the urls to output_dir, see BulkFetch for the options.
+
+    Return the counts of fetched, failed and skipped urls.
+
+    """
+    return BulkFetch(client, output_dir, **kwargs).run(urls)
+
+
+def get_args_parser():
+    parser = ArgumentParser(prog='proctor fetch',
+                            description=__doc__.split('\n')[0])
+    parser.add_argument('input', nargs='?', default='-',
+                        help='File of urls, one per line (default: stdin)')
+    parser.add_argument('-o', '--output', required=True,
+                        help='Directory where results are written, and '
+                             'read from to resume')
+    parser.add_argument('-j', '--concurrency', type=int, default=32,
+                        help='Number of fetches in flight')
+    parser.add_argument('-r', '--retries', type=int, default=2,
+                        help='Number of times failed fetches are retried')
+    parser.add_argument('--no-bodies', action='store_true',
+                        help='Only keep the status and headers of responses')
+    parser.add_argument('--timeout', type=float, default=30,
+                        help='Socket timeout in seconds')
+    add_swarm_arguments(parser, instances=4)
+    add_loglevel_argument(parser)
+    add_rate_limit_arguments(parser)
+    return parser
+
+
+def main(argv=None):
+    args = get_args_parser().parse_args(argv)
+    logging.basicConfig(level=getattr(logging, args.loglevel),
+                        format=LOG_FORMAT)
+    from proctor.client import TorClient
+    from proctor.ratelimit import HostLimiter
+    from proctor.tor import TorSwarm
+
+    work_dir = args.work_dir or mkdtemp()
+    rate_limiter = None
+    options = rate_limit_options(args)
+    if options:
+        rate_limiter = HostLimiter(**options)
+    tor_swarm = TorSwarm(args.base_socks_port, args.base_control_port,
+                         work_dir, args.max_use, **swarm_options(args))
+
+    def kill_handler():
+        tor_swarm.stop()
+        if not args.work_dir:
+            rmtree(work_dir)
+
+    with handle_exit(kill_handler):
+        tor_instances = tor_swarm.start(args.instances)
+        log.debug('Waiting for at least one connected Tor instance...')
+        while not [t for t in tor_instances if t.connected]:
+            if not [t for t in tor_instances if not t.terminated]:
+                log.critical('No alive Tor instance left. Bailing out.')
+                sys.exit(1)
+            sleep(0.25)
+        client = TorClient(tor_swarm, timeout=args.timeout,
+                           rate_limiter=rate_limiter)
+        counts = bulk_fetch(client,
+                            read_urls(args.input), args.output,
+                            concurrency=args.concurrency,
+                            retries=args.retries,
+                            save_bodies=not args.no_bodies)
+        log.info('Done: %(fetched)d urls fetched, %(failed)d failed, '
+                 '%(skipped)d skipped' % counts)
+        if rate_limiter is not None:
+            for host, stats in sorted(rate_limiter.stats().iteritems()):
+                log.debug('Host %s: %s' % (host, stats))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
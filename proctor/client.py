@@ -0,0 +1,208 @@
+""" A client sending HTTP requests through the Tor swarm from its own process.
+
+Scrapers written in Python can embed the swarm instead of going through the
+proxy: requests skip the local hop to the proxy, are parsed once, and HTTPS
+is not decrypted and encrypted again by the MITM layer. Instances are picked
+and their health accounted for just like for proxied requests.
+
+    swarm = TorSwarm(19050, 18118, work_dir, None)
+    swarm.start(4)
+    client = TorClient(swarm)
+    response = client.get('https://example.com/')
+    print response.status, len(response.body)
+
+"""
+from __future__ import absolute_import
+
+import logging
+from httplib import HTTPConnection, HTTPS_PORT
+from multiprocessing.pool import ThreadPool
+from time import time
+from urlparse import urlparse, urlunparse
+
+from proctor.scheduler import Scheduler
+from proctor.tls import UpstreamTLS
+
+log = logging.getLogger(__name__)
+
+
+class TorHTTPConnection(HTTPConnection):
+    """ An httplib connection going through a Tor instance.
+
+    The request is sent as SOCKS5 optimistic data, right behind the CONNECT
+    request to Tor, and the SOCKS reply is read before the response.
+
+    """
+    def __init__(self, tor_instance, host, port=None, timeout=10):
+        HTTPConnection.__init__(self, host, port, timeout=timeout)
+        self.tor_instance = tor_instance
+        self._tor_sock = None
+
+    def _create_socket(self):
+        sock = None
+        while sock is None:  # None when another thread holds the instance.
+            sock = self.tor_instance.create_socket()
+        sock.settimeout(self.timeout)
+        self._tor_sock = sock
+        return sock
+
+    def connect(self):
+        self.sock = self._create_socket()
+        self.sock.connect_optimistic((self.host, self.port))
+
+    def getresponse(self, *args, **kwargs):
+        if self._tor_sock is not None:
+            self._tor_sock.complete_connect()
+        return HTTPConnection.getresponse(self, *args, **kwargs)
+
+    def close(self):
+        HTTPConnection.close(self)
+        # Wrapping sockets in TLS hides them, close the Tor one explicitly so
+        # that its statistics get back to the instance.
+        if self._tor_sock is not None:
+            self._tor_sock.close()
+            self._tor_sock = None
+
+
+class TorHTTPSConnection(TorHTTPConnection):
+    """ An httplib HTTPS connection going through a Tor instance.
+
+    Like with the proxy, the certificates of destinations are not verified.
+
+    """
+    default_port = HTTPS_PORT
+
+    def __init__(self, tor_instance, host, port=None, timeout=10,
+                 upstream_tls=None):
+        TorHTTPConnection.__init__(self, tor_instance, host, port, timeout)
+        self.upstream_tls = upstream_tls or UpstreamTLS()
+
+    def connect(self):
+        sock = self._create_socket()
+        sock.connect((self.host, self.port))
+        self.sock = self.upstream_tls.wrap(sock, self.host)
+
+
+class Response(object):
+    """ The response to a request, with its body read in full. """
+    def __init__(self, status, reason, headers, body, instance, elapsed):
+        self.status = status
+        self.reason = reason
+        self.headers = headers  # A mimetools.Message, like with httplib.
+        self.body = body
+        self.instance = instance  # Name of the Tor instance used.
+        self.elapsed = elapsed
+
+    def __repr__(self):
+        return '<Response %s %s, %d bytes via %s>' % (
+            self.status, self.reason, len(self.body), self.instance)
+
+
+class TorClient(object):
+    """ Sends HTTP(S) requests through the Tor swarm.
+
+    Each request gets its own connection through an instance picked by
+    `scheduler`, which may be shared with a proxy running in the same process
+    (see tor_proxy_handler_factory), or else one is created for the swarm.
+    For sticky routing, pass an AffinityScheduler (see proctor.affinity).
+    Sockets time out after `timeout` seconds. Requests wait for the limits
+    of `rate_limiter` (see proctor.ratelimit) if given, which can also be
+    shared with a proxy.
+
+    A client can be used by several threads at once.
+
+    """
+    def __init__(self, tor_swarm, scheduler=None, timeout=10,
+                 rate_limiter=None):
+        self.tor_swarm = tor_swarm
+        self.scheduler = scheduler or Scheduler(tor_swarm)
+        self.timeout = timeout
+        self.rate_limiter = rate_limiter
+        self.upstream_tls = UpstreamTLS()
+
+    def connection(self, tor_instance, url):
+        """ Return an unopened connection to the host of the url. """
+        u = urlparse(url)
+        if u.scheme == 'http':
+            return TorHTTPConnection(tor_instance, u.hostname, u.port,
+                                     self.timeout)
+        if u.scheme == 'https':
+            return TorHTTPSConnection(tor_instance, u.hostname, u.port,
+                                      self.timeout, self.upstream_tls)
+        raise ValueError('Unknown scheme %s' % repr(u.scheme))
+
+    def request(self, method, url, body=None, headers=None):
+        """ Send a request, and return its Response. """
+        u = urlparse(url)
+        if u.scheme not in ('http', 'https'):
+            raise ValueError('Unknown scheme %s' % repr(u.scheme))
+        path = urlunparse(('', '', u.path or '/', u.params, u.query, ''))
+        start_time = time()
+        accept = None
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(u.hostname)
+            accept = self.rate_limiter.accept(u.hostname)
+        try:
+            request_key = getattr(self.scheduler, 'request_key', None)
+            if request_key is None:
+                tor_instance = self.scheduler.pick(accept)
+            else:
+                tor_instance = self.scheduler.pick(
+                    accept, request_key(u.hostname, headers or dict()))
+            conn = self.connection(tor_instance, url)
+            try:
+                conn.request(method, path, body, headers or dict())
+                response = conn.getresponse()
+                content = response.read()
+            finally:
+                conn.close()
+        finally:
+            if self.rate_limiter is not None:
+                self.rate_limiter.release(u.hostname)
+        return Response(response.status, response.reason, response.msg,
+                        content, tor_instance.name, time() - start_time)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, body, **kwargs):
+        return self.request('POST', url, body, **kwargs)
+
+
+class AsyncTorClient(TorClient):
+    """ A TorClient whose requests can be sent without waiting for them.
+
+    submit() hands the request to one of `workers` threads, and returns a
+    multiprocessing AsyncResult; its get() returns the Response or raises
+    the error of the request. The optional `callback` is called with the
+    Response by the worker thread, when the request succeeded.
+
+    """
+    def __init__(self, tor_swarm, workers=16, **kwargs):
+        super(AsyncTorClient, self).__init__(tor_swarm, **kwargs)
+        self._pool = ThreadPool(workers)
+
+    def submit(self, method, url, callback=None, **kwargs):
+        """ Queue a request, see TorClient.request() for the arguments. """
+        return self._pool.apply_async(self.request, (method, url), kwargs,
+                                      callback)
+
+    def map(self, method, urls, **kwargs):
+        """ Send a request to each url, and yield the results in order.
+
+        Failed requests yield their exception instead of a Response.
+
+        """
+        def request(url):
+            try:
+                return self.request(method, url, **kwargs)
+            except Exception, e:
+                log.debug('Request to %s failed: %s' % (url, e))
+                return e
+
+        return self._pool.imap(request, urls)
+
+    def close(self):
+        """ Wait for the queued requests, and stop the worker threads. """
+        self._pool.close()
+        self._pool.join()
@@ -0,0 +1,118 @@
+""" A persistent cache of Tor directory documents shared by Tor instances.
+
+Before it can build circuits, a Tor process needs a recent consensus and the
+descriptors of the relays it lists. Tor keeps them in its data directory, so
+copying the documents of an instance that already bootstrapped into the data
+directory of a new one spares it most of the downloads.
+
+"""
+
+import logging
+import os
+import shutil
+from datetime import datetime
+from os import path
+from threading import Lock
+
+log = logging.getLogger(__name__)
+
+CONSENSUS = 'cached-microdesc-consensus'
+DOCUMENTS = ('cached-certs', CONSENSUS, 'cached-microdescs',
+             'cached-microdescs.new')
+
+
+def consensus_times(consensus_file):
+    """ Return the (valid-after, valid-until) datetimes of a consensus file.
+
+    Return None if the file is missing or unreadable.
+
+    """
+    times = dict()
+    try:
+        with open(consensus_file) as f:
+            for line in f:
+                keyword, _, value = line.strip().partition(' ')
+                if keyword in ('valid-after', 'valid-until'):
+                    times[keyword] = datetime.strptime(value,
+                                                       '%Y-%m-%d %H:%M:%S')
+                    if len(times) == 2:
+                        return times['valid-after'], times['valid-until']
+                elif keyword in ('dir-source', 'r'):
+                    break  # Past the preamble.
+    except (IOError, ValueError):
+        pass
+    return None
+
+
+class DirectoryCache(object):
+    """ Stores the directory documents of bootstrapped Tor instances.
+
+    The cache holds the documents that came with the most recent consensus
+    seen. A consensus is considered stale once past its valid-until time
+    (which is when Tor stops using it as is), and is then not used for
+    seeding anymore.
+
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self._lock = Lock()
+        if not path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _consensus_times(self, directory):
+        return consensus_times(path.join(directory, CONSENSUS))
+
+    def is_fresh(self):
+        """ Tell whether the cache holds a consensus usable as is. """
+        times = self._consensus_times(self.cache_dir)
+        return times is not None and times[1] > datetime.utcnow()
+
+    def seed(self, data_dir):
+        """ Copy the cached documents to a Tor data directory.
+
+        Nothing is done if the cache is stale, or if the data directory
+        already holds a consensus at least as recent. Return whether the
+        documents were copied.
+
+        """
+        with self._lock:
+            cached = self._consensus_times(self.cache_dir)
+            if cached is None or cached[1] <= datetime.utcnow():
+                return False
+            current = self._consensus_times(data_dir)
+            if current is not None and current[0] >= cached[0]:
+                return False
+            if not path.exists(data_dir):
+                os.makedirs(data_dir)
+            self._copy(self.cache_dir, data_dir)
+            return True
+
+    def update(self, data_dir):
+        """ Store the documents of a Tor data directory if more recent.
+
+        Return whether the cache was updated.
+
+        """
+        with self._lock:
+            current = self._consensus_times(data_dir)
+            if current is None:
+                return False
+            cached = self._consensus_times(self.cache_dir)
+            if cached is not None and cached[0] >= current[0]:
+                return False
+            self._copy(data_dir, self.cache_dir)
+            log.debug('Directory cache updated with consensus valid after %s'
+                      % current[0])
+            return True
+
+    def _copy(self, src_dir, dst_dir):
+        # Copied aside then renamed, so that a Tor process starting at the
+        # same time never sees partial files. The consensus goes last.
+        for name in sorted(DOCUMENTS, key=lambda name: name == CONSENSUS):
+            src = path.join(src_dir, name)
+            if not path.exists(src):
+                continue
+            dst = path.join(dst_dir, name)
+            tmp = '%s.%d.tmp' % (dst, os.getpid())
+            shutil.copyfile(src, tmp)
+            os.rename(tmp, dst)
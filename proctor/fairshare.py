@@ -0,0 +1,209 @@
+""" Sharing the Tor swarm fairly between the clients of the proxy.
+
+Without it requests are served first come, first served, so a client sending
+many requests at once makes all the others wait behind them. A FairShare
+limits the requests in progress, and lets waiting requests in by weighted
+fair queuing between clients.
+
+"""
+import logging
+from base64 import b64decode
+from heapq import heappop, heappush
+from itertools import count
+from threading import Event, Lock
+from time import time
+
+log = logging.getLogger(__name__)
+
+
+class _Client(object):
+    """ The settings, queue position and statistics of a client. """
+    def __init__(self, weight, quota):
+        self.weight = float(weight)
+        self.quota = quota
+        self.tag = 0.0  # Virtual finish time of its last request.
+        self.active = 0
+        self.waiting = 0
+        self.waiting_max = 0
+        self.requests = 0
+        self.queued = 0
+        self.wait_time = 0.0
+        self.wait_max = 0.0
+
+    @property
+    def full(self):
+        return bool(self.quota and self.active >= self.quota)
+
+
+class FairShare(object):
+    """ Admits requests in progress by weighted fair queuing between clients.
+
+    At most `capacity` requests are in progress at once; it can also be a
+    function returning the current capacity, e.g. proportional to the
+    number of connected Tor instances. Waiting requests are let in in the
+    order of their virtual finish time: a client with a weight of 2 gets
+    twice as many requests in as a client with a weight of 1 while both
+    have requests waiting, and a client alone gets all the capacity.
+    A client also never has more than its quota of requests in progress.
+
+    Clients are identified by their address, or with `by_user` by the user
+    name in their Proxy-Authorization header (see identify()). `clients`
+    maps client ids to (weight, quota) tuples; the others get `weight` and
+    `quota`, None meaning no quota.
+
+    """
+    check_interval = 1  # Seconds between checks of a changing capacity.
+
+    def __init__(self, capacity, clients=None, weight=1, quota=None,
+                 by_user=False):
+        self.capacity = capacity
+        self.clients_options = dict(clients or ())
+        self.weight = weight
+        self.quota = quota
+        self.by_user = by_user
+        self.active = 0
+        self._clients = dict()
+        self._queue = list()
+        self._sequence = count()
+        self._virtual_time = 0.0
+        self._lock = Lock()
+
+    @property
+    def waiting(self):
+        """ Return the number of requests waiting for their turn. """
+        return len(self._queue)
+
+    def identify(self, client_address, headers, default=None):
+        """ Return the id of the client sending a request.
+
+        With `by_user`, requests without credentials get `default`, which
+        is meant to be the id from a previous request of the connection
+        (e.g. the CONNECT of an intercepted one) if any.
+
+        """
+        if self.by_user:
+            scheme, _, credentials = headers.get(
+                'Proxy-Authorization', '').partition(' ')
+            if scheme.lower() == 'basic':
+                try:
+                    user = b64decode(credentials.strip()).split(':', 1)[0]
+                except TypeError:
+                    user = None  # Not base64.
+                if user:
+                    return user
+            if default is not None:
+                return default
+        return client_address[0]
+
+    def _client(self, client_id):
+        """ Return the state of a client, called with the lock held. """
+        client = self._clients.get(client_id)
+        if client is None:
+            weight, quota = self.clients_options.get(
+                client_id, (self.weight, self.quota))
+            client = self._clients[client_id] = _Client(weight, quota)
+        return client
+
+    def _room(self):
+        capacity = self.capacity
+        if callable(capacity):
+            capacity = capacity()
+        return self.active < capacity
+
+    def _admit(self, client, tag):
+        self.active += 1
+        client.active += 1
+        self._virtual_time = max(self._virtual_time, tag)
+
+    def _dispatch(self):
+        """ Let waiting requests in while there is room, by virtual time. """
+        skipped = list()
+        while self._queue and self._room():
+            entry = heappop(self._queue)
+            tag, _, client, admitted = entry
+            if client.full:
+                skipped.append(entry)
+                continue
+            self._admit(client, tag)
+            admitted.set()
+        for entry in skipped:
+            heappush(self._queue, entry)
+
+    def acquire(self, client_id):
+        """ Wait until the client may have one more request in progress.
+
+        Every acquire() must be followed by a release() once the request is
+        done. Return the time spent waiting.
+
+        """
+        start_time = time()
+        with self._lock:
+            client = self._client(client_id)
+            client.requests += 1
+            client.tag = (max(self._virtual_time, client.tag)
+                          + 1 / client.weight)
+            if not self._queue and not client.full and self._room():
+                self._admit(client, client.tag)
+                return 0.0
+            admitted = Event()
+            heappush(self._queue,
+                     (client.tag, next(self._sequence), client, admitted))
+            # Clients at their quota may be in the way of this one.
+            self._dispatch()
+            client.queued += 1
+            client.waiting += 1
+            client.waiting_max = max(client.waiting_max, client.waiting)
+        while not admitted.wait(self.check_interval):
+            # The capacity may have grown without a release.
+            with self._lock:
+                self._dispatch()
+        wait_time = time() - start_time
+        with self._lock:
+            client.waiting -= 1
+            client.wait_time += wait_time
+            client.wait_max = max(client.wait_max, wait_time)
+        return wait_time
+
+    def release(self, client_id):
+        """ Let the next request in, one of the client's is done. """
+        with self._lock:
+            client = self._clients[client_id]
+            client.active -= 1
+            self.active -= 1
+            self._dispatch()
+
+    def stats(self):
+        """ Return the statistics of each client, in a dict by client id.
+
+        Each value is a dict with the requests in progress and waiting (and
+        the maximum waiting at once), the total requests, their share of all
+        the requests, those that had to wait, and the average and maximum
+        wait times.
+
+        """
+        with self._lock:
+            total = sum(c.requests for c in self._clients.values()) or 1
+            return dict(
+                (client_id, dict(active=c.active, waiting=c.waiting,
+                                 waiting_max=c.waiting_max,
+                                 requests=c.requests,
+                                 share=float(c.requests) / total,
+                                 queued=c.queued,
+                                 wait_avg=c.wait_time / (c.requests or 1),
+                                 wait_max=c.wait_max))
+                for client_id, c in self._clients.iteritems())
+
+
+def parse_client(value):
+    """ Parse a CLIENT=WEIGHT[,QUOTA] command line argument.
+
+    Return a (client id, (weight, quota)) item for FairShare.
+
+    """
+    client_id, sep, options = value.partition('=')
+    if not (client_id and sep):
+        raise ValueError('Expected CLIENT=WEIGHT[,QUOTA]: %s' % value)
+    weight, _, quota = options.partition(',')
+    if float(weight) <= 0:
+        raise ValueError('Weights must be positive: %s' % value)
+    return client_id, (float(weight), int(quota) if quota else None)
@@ -0,0 +1,177 @@
+""" Health policies deciding what to do with struggling Tor instances.
+
+A policy is created for each TorProcess, by calling the `health_policy` given
+to it with the instance. It is asked every second whether the instance needs
+a restart, decides which requests the instance may get, and is told about
+the outcome of each connection.
+
+"""
+import logging
+from threading import Lock
+
+log = logging.getLogger(__name__)
+
+
+class RestartPolicy(object):
+    """ Restarts unhealthy instances, which get traffic until then.
+
+    Once past its grace time, an instance is unhealthy when its errors over
+    the statistics window exceed `errors_max`, or when its average connection
+    time exceeds `conn_time_avg_max` (attributes of the TorProcess). It is
+    also restarted after `sockets_max` sockets.
+
+    """
+    blocked = False
+
+    def __init__(self, tor):
+        self.tor = tor
+
+    def unhealthy(self):
+        """ Return why the statistics of the instance are bad, or None. """
+        errors, timing_avg, samples = self.tor.get_stats()
+        if errors > self.tor.errors_max:
+            return 'errors'
+        if timing_avg > self.tor.conn_time_avg_max:
+            return 'slow'
+        return None
+
+    def worn_out(self):
+        """ Tell whether the instance handed out its maximum of sockets. """
+        return bool(self.tor.sockets_max
+                    and self.tor.socket_count >= self.tor.sockets_max)
+
+    def check(self):
+        """ Return why the instance should be restarted, or None. """
+        if self.tor.age <= self.tor.grace_time:
+            return None
+        reason = self.unhealthy()
+        if reason is None and self.worn_out():
+            reason = 'max use'
+        return reason
+
+    def admit(self):
+        """ Tell whether the instance may take a new request. """
+        return True
+
+    def on_result(self, timing, errors):
+        """ Account for the outcome of a connection through the instance. """
+
+    def reset(self):
+        """ Forget the past, the Tor process was (re)started. """
+
+
+class CircuitBreaker(RestartPolicy):
+    """ Stops sending traffic to unhealthy instances before restarting them.
+
+    The breaker starts closed, the instance getting its share of requests.
+    When the instance turns unhealthy the breaker opens: the instance gets
+    no requests for `open_time` seconds, after which the breaker goes
+    half-open and lets `trials` requests through, one at a time. If they
+    all connect without error and in less than `conn_time_avg_max` the
+    breaker closes again with fresh statistics, otherwise it opens again.
+
+    The instance is only restarted once it has handed out its maximum of
+    sockets, or when the breaker is still open or half-open `open_time_max`
+    seconds after it first opened. Closing does not count as a recovery
+    until the breaker stays closed for `open_time_max` seconds, so that
+    flapping instances get restarted too.
+
+    """
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, tor, open_time=10, open_time_max=120, trials=3):
+        super(CircuitBreaker, self).__init__(tor)
+        self.open_time = open_time
+        self.open_time_max = open_time_max
+        self.trials = trials
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self._opened_time = self._tripped_time = self._closed_time = None
+            self._trials_started = self._trials_done = 0
+            self._trial_time = None
+
+    @property
+    def blocked(self):
+        """ Tell whether admit() would refuse a request now. """
+        return self.state != self.CLOSED and not (
+            self.state == self.HALF_OPEN and self._trial_available())
+
+    def _trial_available(self):
+        return (self._trials_started == self._trials_done
+                and self._trials_started < self.trials)
+
+    def _seconds_since(self, time):
+        return (self.tor.clock() - time).total_seconds()
+
+    def check(self):
+        if self.tor.age <= self.tor.grace_time:
+            return None
+        if self.worn_out():
+            return 'max use'
+        with self._lock:
+            if self.state == self.CLOSED:
+                reason = self.unhealthy()
+                if reason is not None:
+                    self._open(reason)
+                elif (self._tripped_time is not None
+                      and self._seconds_since(self._closed_time)
+                      > self.open_time_max):
+                    self._tripped_time = None
+                return None
+            if self._seconds_since(self._tripped_time) > self.open_time_max:
+                return 'breaker open'
+            if self.state == self.OPEN:
+                if self._seconds_since(self._opened_time) >= self.open_time:
+                    self._half_open()
+            elif self._seconds_since(self._trial_time) > self.open_time:
+                # The trial request went nowhere.
+                self._open('trial timed out')
+        return None
+
+    def admit(self):
+        if self.state == self.CLOSED:
+            return True
+        with self._lock:
+            if self.state == self.HALF_OPEN and self._trial_available():
+                self._trials_started += 1
+                self._trial_time = self.tor.clock()
+                return True
+            return self.state == self.CLOSED
+
+    def on_result(self, timing, errors):
+        if self.state != self.HALF_OPEN:
+            return
+        with self._lock:
+            # Connections opened before the breaker opened may end now.
+            if (self.state != self.HALF_OPEN
+                    or self._trials_done >= self._trials_started):
+                return
+            self._trials_done += 1
+            self._trial_time = self.tor.clock()
+            if errors or timing > self.tor.conn_time_avg_max:
+                self._open('trial failed')
+            elif self._trials_done >= self.trials:
+                self._close()
+
+    def _open(self, reason):
+        log.info('Circuit breaker of %s open (%s)' % (self.tor.name, reason))
+        self.state = self.OPEN
+        self._opened_time = self.tor.clock()
+        if self._tripped_time is None:
+            self._tripped_time = self._opened_time
+
+    def _half_open(self):
+        log.debug('Circuit breaker of %s half-open' % self.tor.name)
+        self.state = self.HALF_OPEN
+        self._trials_started = self._trials_done = 0
+        self._trial_time = self.tor.clock()
+
+    def _close(self):
+        log.info('Circuit breaker of %s closed' % self.tor.name)
+        self.tor.reset_stats()
+        self.state = self.CLOSED
+        self._closed_time = self.tor.clock()
@@ -0,0 +1,160 @@
+""" Streaming interceptor plugins.
+
+Unlike the miproxy request and response interceptors, which are handed whole
+messages, streaming interceptors see a message as its head (start line and
+headers), followed by any number of body chunks and an end-of-message
+notification, so they can inspect or rewrite traffic in constant memory.
+
+Each hook returns the data to pass on to the next plugin: the (possibly
+rewritten) head, the (possibly rewritten, possibly empty) chunk, and any extra
+body data to append at the end of the message. Body chunks are decoded, the
+proxy takes care of the transfer encoding of what the plugins return.
+
+A plugin may return None from its headers hook to hold the head back; its end
+hook must then return the whole message, head included. This is how
+whole-message miproxy plugins are run, see WholeMessageAdapter.
+
+"""
+
+from miproxy.proxy import (
+    InterceptorPlugin, RequestInterceptorPlugin, ResponseInterceptorPlugin)
+
+
+class StreamRequestInterceptorPlugin(InterceptorPlugin):
+    def on_request_headers(self, head):
+        return head
+
+    def on_request_chunk(self, data):
+        return data
+
+    def on_request_end(self):
+        return ''
+
+
+class StreamResponseInterceptorPlugin(InterceptorPlugin):
+    def on_response_headers(self, head):
+        return head
+
+    def on_response_chunk(self, data):
+        return data
+
+    def on_response_end(self):
+        return ''
+
+
+class WholeMessageAdapter(StreamRequestInterceptorPlugin,
+                          StreamResponseInterceptorPlugin):
+    """ Run a whole-message miproxy plugin as a streaming plugin.
+
+    The message is buffered until its end, then handed to the plugin's
+    do_request() or do_response() method.
+
+    """
+    def __init__(self, plugin_class, server, msg):
+        super(WholeMessageAdapter, self).__init__(server, msg)
+        self.plugin = plugin_class(server, msg)
+        self._parts = list()
+
+    def _hold(self, data):
+        self._parts.append(data)
+        return ''
+
+    def _release(self, hook):
+        data = ''.join(self._parts)
+        self._parts = list()
+        return hook(data)
+
+    def on_request_headers(self, head):
+        self._hold(head)
+        return None
+
+    def on_request_chunk(self, data):
+        return self._hold(data)
+
+    def on_request_end(self):
+        return self._release(self.plugin.do_request)
+
+    def on_response_headers(self, head):
+        self._hold(head)
+        return None
+
+    def on_response_chunk(self, data):
+        return self._hold(data)
+
+    def on_response_end(self):
+        return self._release(self.plugin.do_response)
+
+
+def stream_plugin_factories(interceptor_class):
+    """ Return the (request, response) streaming factories for a plugin.
+
+    Either element is None when the plugin does not apply to that direction.
+    Whole-message miproxy plugins are wrapped in a WholeMessageAdapter.
+
+    """
+    def adapt(plugin_class):
+        def factory(server, msg):
+            return WholeMessageAdapter(plugin_class, server, msg)
+        return factory
+
+    request = response = None
+    if issubclass(interceptor_class, StreamRequestInterceptorPlugin):
+        request = interceptor_class
+    elif issubclass(interceptor_class, RequestInterceptorPlugin):
+        request = adapt(interceptor_class)
+    if issubclass(interceptor_class, StreamResponseInterceptorPlugin):
+        response = interceptor_class
+    elif issubclass(interceptor_class, ResponseInterceptorPlugin):
+        response = adapt(interceptor_class)
+    return request, response
+
+
+class InterceptorChain(object):
+    """ Drive one message through a list of streaming plugins.
+
+    The output of the chain is sent to the write_head, write_body and
+    end_body callables.
+
+    """
+    def __init__(self, plugins, direction, write_head, write_body, end_body):
+        self._hooks = [(getattr(p, 'on_%s_headers' % direction),
+                        getattr(p, 'on_%s_chunk' % direction),
+                        getattr(p, 'on_%s_end' % direction))
+                       for p in plugins]
+        self._held = set()  # Stages that held the head back.
+        self._write_head = write_head
+        self._write_body = write_body
+        self._end_body = end_body
+
+    def headers(self, head):
+        self._headers(0, head)
+
+    def chunk(self, data):
+        self._chunk(0, data)
+
+    def end(self):
+        for stage, hooks in enumerate(self._hooks):
+            data = hooks[2]()
+            if stage in self._held:
+                head, separator, body = data.partition('\r\n\r\n')
+                self._headers(stage + 1, head + separator)
+                self._chunk(stage + 1, body)
+            else:
+                self._chunk(stage + 1, data)
+        self._end_body()
+
+    def _headers(self, first_stage, head):
+        for stage in range(first_stage, len(self._hooks)):
+            head = self._hooks[stage][0](head)
+            if head is None:
+                self._held.add(stage)
+                return
+        self._write_head(head)
+
+    def _chunk(self, first_stage, data):
+        for stage in range(first_stage, len(self._hooks)):
+            if not data:
+                return
+            data = self._hooks[stage][1](data)
+        if data:
+            self._write_body(data)
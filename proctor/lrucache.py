@@ -0,0 +1,29 @@
+""" A bounded mapping keeping the most recently used items. """
+
+from collections import OrderedDict
+from threading import Lock
+
+
+class LRUCache(object):
+    """ A thread-safe mapping that only keeps the most recently used items. """
+    def __init__(self, size):
+        self.size = size
+        self._items = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.pop(key, None)
+            if value is not None:
+                self._items[key] = value
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def __len__(self):
+        return len(self._items)
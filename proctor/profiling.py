@@ -0,0 +1,239 @@
+""" Tools to find out where the time goes in a running proxy.
+
+*   TimedLock is a drop-in Lock that accounts for the time threads spend
+    waiting for it, see lock_stats().
+
+*   SamplingProfiler samples the stacks of all the threads for a while, and
+    writes them in the "collapsed" format of flame graph tools. With
+    profile_on_signal() it runs each time the process receives a signal.
+
+*   Tracer decides which requests get traced, and aggregates the duration
+    of the stages of traced requests.
+
+"""
+import logging
+import os
+import signal
+import sys
+from collections import defaultdict
+from datetime import datetime
+from os import path
+from random import random
+from threading import Lock, Thread, current_thread
+from time import sleep, time
+from weakref import WeakSet
+
+log = logging.getLogger(__name__)
+
+_timed_locks = WeakSet()
+
+
+class TimedLock(object):
+    """ A Lock that keeps track of contention.
+
+    Acquiring a free lock costs one more method call than with a plain Lock,
+    time is only measured when the lock is already held.
+
+    """
+    def __init__(self, name):
+        self.name = name
+        self.acquired = 0
+        self.contended = 0
+        self.failed = 0
+        self.wait_time = 0.0
+        self.wait_max = 0.0
+        self._lock = Lock()
+        _timed_locks.add(self)
+
+    def acquire(self, blocking=True):
+        if self._lock.acquire(False):
+            self.acquired += 1
+            return True
+        if not blocking:
+            self.failed += 1  # Racy, but only statistics.
+            return False
+        start_time = time()
+        self._lock.acquire()
+        wait_time = time() - start_time
+        # The counters are only updated while holding the lock.
+        self.acquired += 1
+        self.contended += 1
+        self.wait_time += wait_time
+        self.wait_max = max(self.wait_max, wait_time)
+        return True
+
+    def release(self):
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def lock_stats():
+    """ Return the statistics of the TimedLocks in use, by lock name.
+
+    Locks sharing a name have their statistics added up. Each value is a
+    dict with the number of acquisitions, those that had to wait, failed
+    non-blocking attempts, and the total and maximum wait times.
+
+    """
+    stats = dict()
+    for lock in list(_timed_locks):
+        s = stats.setdefault(lock.name, dict(acquired=0, contended=0,
+                                             failed=0, wait_time=0.0,
+                                             wait_max=0.0))
+        s['acquired'] += lock.acquired
+        s['contended'] += lock.contended
+        s['failed'] += lock.failed
+        s['wait_time'] += lock.wait_time
+        s['wait_max'] = max(s['wait_max'], lock.wait_max)
+    return stats
+
+
+class SamplingProfiler(Thread):
+    """ Counts the stacks of all threads, sampled every `interval` seconds.
+
+    After `duration` seconds the stacks are written to `output_file`, one
+    per line as semicolon separated frames (outermost first) followed by
+    their sample count, which is what flamegraph.pl and speedscope read.
+
+    """
+    def __init__(self, duration, output_file, interval=0.005):
+        super(SamplingProfiler, self).__init__(name='profiler')
+        self.daemon = True
+        self.duration = duration
+        self.output_file = output_file
+        self.interval = interval
+        self.samples = 0
+        self._stacks = defaultdict(int)
+
+    def run(self):
+        end_time = time() + self.duration
+        while time() < end_time:
+            self._sample()
+            sleep(self.interval)
+        self._write()
+
+    def _sample(self):
+        own_id = current_thread().ident
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+            stack = list()
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s:%s' % (path.basename(code.co_filename),
+                                        code.co_name))
+                frame = frame.f_back
+            self._stacks[';'.join(reversed(stack))] += 1
+        self.samples += 1
+
+    def _write(self):
+        with open(self.output_file, 'w') as f:
+            for stack, count in sorted(self._stacks.iteritems(),
+                                       key=lambda item: -item[1]):
+                f.write('%s %d\n' % (stack, count))
+        log.info('Profile of %d samples written to %s'
+                 % (self.samples, self.output_file))
+
+    def top(self, count=20):
+        """ Return the functions most often on top of a stack.
+
+        They come as (function, share of the stacks sampled) tuples.
+
+        """
+        leaves = defaultdict(int)
+        for stack, samples in self._stacks.iteritems():
+            leaves[stack.rsplit(';', 1)[-1]] += samples
+        total = float(sum(leaves.values()) or 1)
+        return [(function, samples / total) for function, samples
+                in sorted(leaves.iteritems(), key=lambda item: -item[1])
+                [:count]]
+
+
+def profile_on_signal(duration, output_dir, tracer=None, stats=None,
+                      signum=signal.SIGUSR1):
+    """ Profile the process for `duration` seconds on each `signum` signal.
+
+    Profiles are written to `output_dir`. Once a profile is done, the lock
+    statistics and the statistics of the tracer if any are logged as well,
+    and so are those returned by the functions of the `stats` dict, one line
+    per item under the name of the function.
+    Must be called from the main thread.
+
+    """
+    running = list()
+
+    def report(profiler):
+        profiler.join()
+        for function, share in profiler.top():
+            log.info('Profile: %5.1f%% %s' % (100 * share, function))
+        for name, values in sorted(lock_stats().iteritems()):
+            log.info('Lock %s: %s' % (name, values))
+        if tracer is not None:
+            for stage, values in sorted(tracer.stats().iteritems()):
+                log.info('Stage %s (count, avg time, max time): %s'
+                         % (stage, values))
+        for name, function in sorted((stats or {}).iteritems()):
+            for key, values in sorted(function().iteritems()):
+                log.info('%s %s: %s' % (name, key, values))
+        running.remove(profiler)
+
+    def handler(signum, frame):
+        if running:
+            log.warn('Profiling already in progress')
+            return
+        if not path.exists(output_dir):
+            os.makedirs(output_dir)
+        timestamp = datetime.utcnow().strftime('%Y%m%d-%H%M%S')
+        output_file = path.join(output_dir, 'profile-%s.txt' % timestamp)
+        log.info('Profiling for %ss' % duration)
+        profiler = SamplingProfiler(duration, output_file)
+        running.append(profiler)
+        profiler.start()
+        reporter = Thread(target=report, args=(profiler,),
+                          name='profile-report')
+        reporter.daemon = True
+        reporter.start()
+
+    signal.signal(signum, handler)
+
+
+class Tracer(object):
+    """ Samples requests to trace, and keeps the times of their stages.
+
+    A request is traced with a probability of `sample_rate`. Traced requests
+    record spans, (stage, start time, end time) tuples, that are handed back
+    with add() once the request is done.
+
+    """
+    def __init__(self, sample_rate=0.01):
+        self.sample_rate = sample_rate
+        self._counts = defaultdict(int)
+        self._times = defaultdict(float)
+        self._max = defaultdict(float)
+        self._lock = Lock()
+
+    def sampled(self):
+        """ Tell whether to trace a new request. """
+        return random() < self.sample_rate
+
+    def add(self, spans):
+        """ Account for the spans of a traced request. """
+        with self._lock:
+            for stage, start_time, end_time in spans:
+                duration = end_time - start_time
+                self._counts[stage] += 1
+                self._times[stage] += duration
+                self._max[stage] = max(self._max[stage], duration)
+
+    def stats(self):
+        """ Return a dict of stage: (count, average time, max time). """
+        with self._lock:
+            return dict((stage, (count, self._times[stage] / count,
+                                 self._max[stage]))
+                        for stage, count in self._counts.iteritems())
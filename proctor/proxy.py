@@ -1,32 +1,209 @@
+from __future__ import absolute_import
+
 import logging
-from threading import Lock
+from datetime import datetime
+from fnmatch import fnmatch
+from httplib import HTTPException, HTTPResponse
+from time import time
 from urlparse import urlparse, urlunparse, ParseResult
 
 from miproxy.proxy import (
-    ProxyHandler, RequestInterceptorPlugin,
-    ResponseInterceptorPlugin, UnsupportedSchemeException)
-from ssl import wrap_socket
+    AsyncMitmProxy, InterceptorPlugin, InvalidInterceptorPluginException,
+    ProxyHandler, UnsupportedSchemeException)
+from socket import error as socket_error, timeout as socket_timeout
+from ssl import SSLError, wrap_socket
+
+from proctor.affinity import AffinityScheduler
+from proctor.interceptors import (
+    InterceptorChain, StreamRequestInterceptorPlugin,
+    StreamResponseInterceptorPlugin, stream_plugin_factories)
+from proctor.relay import (
+    BUFFER_SIZE, IncompleteBody, chunked_writer, file_read_into,
+    relay_chunked, relay_length, relay_until_close, tunnel)
+from proctor.profiling import lock_stats
+from proctor.scheduler import Scheduler
+from proctor.tls import CertificateCache, UpstreamTLS
 
 log = logging.getLogger(__name__)
 
+# Headers only meaningful for a single connection, RFC 7230 section 6.1.
+HOP_BY_HOP_HEADERS = ('Connection', 'Keep-Alive', 'Proxy-Connection', 'TE',
+                      'Trailer', 'Upgrade')
+
+
+class UpstreamError(Exception):
+    """ A failure of the connection to the destination, see _upstream(). """
+    def __init__(self, error):
+        Exception.__init__(self, str(error) or error.__class__.__name__)
+        self.error = error
+
+
+def _upstream(function):
+    """ Wrap a function using the destination connection.
+
+    Its socket, TLS and HTTP errors are raised as UpstreamErrors, to tell
+    them apart from those of the client connection.
+
+    """
+    def wrapper(*args, **kwargs):
+        try:
+            return function(*args, **kwargs)
+        except (socket_error, SSLError, HTTPException), e:
+            raise UpstreamError(e)
+    return wrapper
+
+
+def _ignore(*args):
+    pass
+
+
+def _replace_headers(head, **headers):
+    """ Replace headers in a message head, removing those set to None.
+
+    Header names are given with underscores instead of dashes.
+
+    """
+    names = dict((name.replace('_', '-').lower(), name) for name in headers)
+    lines = [line for line in head.splitlines()
+             if line and line.split(':', 1)[0].strip().lower() not in names]
+    for name, value in sorted(headers.iteritems()):
+        if value is not None:
+            lines.append('%s: %s' % (name.replace('_', '-'), value))
+    return '\r\n'.join(lines) + '\r\n\r\n'
+
+
+def _hop_by_hop(headers):
+    """ Return the lowercase names of the hop-by-hop headers of a message.
+
+    They include those listed in its Connection header, except the body
+    framing ones since the body is relayed as is.
+
+    """
+    names = set(name.lower() for name in HOP_BY_HOP_HEADERS)
+    for value in headers.getheaders('Connection'):
+        names.update(token.strip().lower() for token in value.split(','))
+    return names - set(('content-length', 'transfer-encoding'))
+
+
+def _end_to_end_head(head, headers, **replacements):
+    """ Remove the hop-by-hop headers from a message head, and replace some.
+
+    See _replace_headers() for the replacements.
+
+    """
+    names = _hop_by_hop(headers)
+    lines = [line for line in head.splitlines()
+             if line.split(':', 1)[0].strip().lower() not in names]
+    return _replace_headers('\r\n'.join(lines), **replacements)
+
+
+def _reframe_head(head, chunked=False, length=None):
+    """ Replace the body framing headers of a message head. """
+    return _replace_headers(
+        head, Transfer_Encoding='chunked' if chunked else None,
+        Content_Length=length)
+
 
 class TorProxyHandler(ProxyHandler):
-    def __init__(self, tor_instance, *args, **kwargs):
-        self.tor_instance = tor_instance
-        ProxyHandler.__init__(self, *args, **kwargs)
+    """ Proxies the requests of a client connection through Tor.
+
+    Client connections are kept alive, for at most `requests_max` requests
+    (unlimited if None) and `idle_timeout` seconds between requests. Each
+    request gets its Tor instance from the scheduler, unless `pin_instance`
+    is true in which case the first instance picked serves the connection.
+
+    When the server has an `access_log` (see proctor.accesslog), a record with
+    the timing of its stages is logged for each request. When it has a
+    `tracer` (see proctor.profiling), the requests it samples record spans
+    for each of their stages. When it has a `rate_limiter` (see
+    proctor.ratelimit), requests wait for their turn to go to their
+    destination host before an instance is picked for them. When it has a
+    `fair_share` (see proctor.fairshare), they then wait for their turn
+    among the requests of all clients.
+
+    When the destination connection fails, the client gets a 502 or 504 error
+    response, or its connection is closed if part of the response was already
+    relayed.
 
-    def _connect_to_host(self):
+    """
+    protocol_version = 'HTTP/1.1'
+    buffer_size = BUFFER_SIZE
+    tunnel_idle_timeout = 300
+
+    def __init__(self, scheduler, request, client_address, server,
+                 requests_max=None, idle_timeout=None, pin_instance=False):
+        self.scheduler = scheduler
+        self.requests_max = requests_max
+        self.timeout = idle_timeout  # Applied to the socket by setup().
+        self.pin_instance = pin_instance
+        self.requests_count = 0
+        self.tor_instance = None
+        self.is_tunnel = False
+        self._proxy_sock = None
+        self._tor_sock = None
+        self._limited_host = None
+        self._client_id = None
+        self._fair_client = None
+        # Single relay buffer for the lifetime of the client connection.
+        self._relay_buffer = memoryview(bytearray(self.buffer_size))
+        ProxyHandler.__init__(self, request, client_address, server)
+
+    def handle_one_request(self):
+        self.requests_count += 1
+        try:
+            ProxyHandler.handle_one_request(self)
+        except (IOError, SSLError), e:
+            # Client went away, possibly without a proper TLS shutdown or in
+            # the middle of a request body.
+            log.debug('Client connection lost: %s' % e)
+            self.close_connection = 1
+        if self.requests_max and self.requests_count >= self.requests_max:
+            self.close_connection = 1
+
+    def parse_request(self):
+        self._request_time = time()
+        self._timings = dict()
+        self._status = self._bytes = None
+        self._response_started = False
+        tracer = getattr(self.server, 'tracer', None)
+        self._spans = list() if tracer and tracer.sampled() else None
+        if not ProxyHandler.parse_request(self):
+            return False
+        # Clients talking to a proxy often use this non-standard header.
+        if 'Connection' not in self.headers:
+            conntype = self.headers.get('Proxy-Connection', '').lower()
+            if conntype == 'close':
+                self.close_connection = 1
+            elif conntype == 'keep-alive':
+                self.close_connection = 0
+        return True
+
+    def log_request(self, code='-', size='-'):
+        self._status = code
+        ProxyHandler.log_request(self, code, size)
+
+    def _span(self, stage, start_time):
+        """ Record a trace span for a stage ending now, return the time. """
+        end_time = time()
+        if self._spans is not None:
+            self._spans.append((stage, start_time, end_time))
+        return end_time
+
+    @property
+    def last_request(self):
+        """ Tell whether the connection closes after the current request. """
+        return bool(self.close_connection or (
+            self.requests_max and self.requests_count >= self.requests_max))
+
+    def _connect_to_host(self, optimistic=False):
         # Get hostname and port to connect to
-        if self.is_connect:
+        if self.command == 'CONNECT':
             self.hostname, self.port = self.path.split(':')
-            log.debug('Connecting to %s:%s' % (self.hostname, self.port))
-        else:
+        elif not self.is_connect:
             u = urlparse(self.path)
             if u.scheme != 'http':
                 raise UnsupportedSchemeException('Unknown scheme %s'
                                                  % repr(u.scheme))
-            log.debug('Using %s to fetch %s'
-                      % (self.tor_instance.name, self.path))
             self.hostname = u.hostname
             self.port = u.port or 80
             self.path = urlunparse(
@@ -35,16 +212,328 @@ class TorProxyHandler(ProxyHandler):
                             fragment=u.fragment))
 
         # Connect to destination
+        start_time = self._span('admission', self._request_time)
+        accept = None
+        rate_limiter = getattr(self.server, 'rate_limiter', None)
+        if rate_limiter is not None:
+            self._timings['host_wait'] = rate_limiter.acquire(self.hostname)
+            self._limited_host = self.hostname
+            accept = rate_limiter.accept(self.hostname)
+            start_time = self._span('host_wait', start_time)
+        fair_share = getattr(self.server, 'fair_share', None)
+        if fair_share is not None:
+            self._client_id = fair_share.identify(
+                self.client_address, self.headers, self._client_id)
+            if fair_share.by_user:
+                # Meant for us, not for the destination.
+                del self.headers['Proxy-Authorization']
+            self._timings['fair_wait'] = fair_share.acquire(self._client_id)
+            self._fair_client = self._client_id
+            start_time = self._span('fair_wait', start_time)
+        # A pinned instance goes through the same checks as picked ones:
+        # half-open circuit breakers only let a few trial requests in, and
+        # instances have a rate limit per host.
+        if not (self.pin_instance and self.tor_instance is not None
+                and self.scheduler.admits(self.tor_instance, accept)):
+            request_key = getattr(self.scheduler, 'request_key', None)
+            if request_key is None:
+                self.tor_instance = self.scheduler.pick(accept)
+            else:
+                self.tor_instance = self.scheduler.pick(
+                    accept, request_key(self.hostname, self.headers))
+        self._connect_time = self._span('pick', start_time)
+        self._timings['queue_wait'] = self._connect_time - start_time
         self._proxy_sock = None
         while self._proxy_sock is None:
             self._proxy_sock = self.tor_instance.create_socket(
                 suppress_errors=True)
         self._proxy_sock.settimeout(10)
+        self._tor_sock = self._proxy_sock
+        if optimistic:
+            # The caller reads the SOCKS reply with complete_connect().
+            self._proxy_sock.connect_optimistic(
+                (self.hostname, int(self.port)))
+            self._span('connect', self._connect_time)
+            return
         self._proxy_sock.connect((self.hostname, int(self.port)))
+        start_time = self._span('connect', self._connect_time)
+        self._timings['connect'] = start_time - self._connect_time
 
         # Wrap socket if SSL is required
-        if self.is_connect:
-            self._proxy_sock = wrap_socket(self._proxy_sock)
+        if self.is_connect and not self.is_tunnel:
+            upstream_tls = getattr(self.server, 'upstream_tls', None)
+            if upstream_tls is None:
+                self._proxy_sock = wrap_socket(self._proxy_sock)
+            else:
+                self._proxy_sock = upstream_tls.wrap(self._proxy_sock,
+                                                     self.hostname)
+            self._timings['tls'] = self._span('tls', start_time) - start_time
+
+    def _transition_to_ssl(self):
+        context = getattr(self.server.ca, 'context', None)
+        if context is None:
+            return ProxyHandler._transition_to_ssl(self)
+        self.request = context(self.path.split(':')[0]).wrap_socket(
+            self.request, server_side=True)
+
+    def do_CONNECT(self):
+        hostname = self.path.split(':')[0]
+        tunnels = getattr(self.server, 'tunnels', None)
+        if tunnels is None or not tunnels(hostname):
+            return ProxyHandler.do_CONNECT(self)
+
+        # Pass-through tunnel, the TLS session is between the client and the
+        # destination.
+        self.is_connect = self.is_tunnel = True
+        try:
+            self._connect_to_host()
+        except Exception, e:
+            self._close_proxy_sock()
+            self.send_error(500, str(e))
+            self._end_request()
+            return
+        try:
+            self.send_response(200, 'Connection established')
+            self.end_headers()
+            start_time = time()
+            # What the client sent right behind the CONNECT, e.g. a pipelined
+            # ClientHello, is already in the read buffer.
+            buffered = self.rfile._rbuf.getvalue()
+            if buffered:
+                self._proxy_sock.sendall(buffered)
+            tunnel(self.connection, self._proxy_sock, self._relay_buffer,
+                   self.tunnel_idle_timeout)
+            self._span('relay', start_time)
+        finally:
+            self._close_proxy_sock()
+            self._end_request()
+        self.close_connection = 1
+
+    def do_COMMAND(self):
+        # Interceptors registered with a plain miproxy server need whole
+        # messages, let miproxy buffer them.
+        if self.server._req_plugins or self.server._res_plugins:
+            # Its responses are not always framed, so it cannot keep alive.
+            self.close_connection = 1
+            return ProxyHandler.do_COMMAND(self)
+
+        try:
+            self._proxy_request()
+        finally:
+            self._end_request()
+
+    def _proxy_request(self):
+        """ Relay the current request and its response. """
+        # Plain HTTP requests are sent before the SOCKS reply comes back, TLS
+        # needs the connection first.
+        optimistic = not self.is_connect
+        # Intercepted CONNECTs have their first connection opened already.
+        if self._proxy_sock is None:
+            try:
+                self._connect_to_host(optimistic)
+            except Exception, e:
+                self._close_proxy_sock()
+                self.send_error(500, str(e))
+                return
+        try:
+            start_time = time()
+            self._relay_request()
+            start_time = self._span('send', start_time)
+            if optimistic:
+                try:
+                    self._proxy_sock.complete_connect()
+                except Exception, e:
+                    # SOCKS errors are not socket errors.
+                    raise UpstreamError(e)
+                end_time = self._span('connect_reply', start_time)
+                self._timings['connect'] = end_time - self._connect_time
+            self._relay_response()
+        except UpstreamError, e:
+            self._upstream_failed(e.error)
+        finally:
+            self._close_proxy_sock()
+
+    def _upstream_failed(self, error):
+        """ Answer a request whose destination connection failed. """
+        log.info('Upstream error for %s:%s: %s'
+                 % (self.hostname, self.port,
+                    str(error).strip() or error.__class__.__name__))
+        if self._response_started:
+            # Too late for an error response, the client sees a cut one.
+            self.close_connection = 1
+        elif isinstance(error, socket_timeout):
+            self.send_error(504, 'Upstream timeout')
+        else:
+            self.send_error(502, 'Upstream error')
+
+    def _close_proxy_sock(self):
+        """ Close the connection to the destination, and free its slots.
+
+        Also called when the connection failed half-way.
+
+        """
+        if self._proxy_sock is not None:
+            self._proxy_sock.close()
+            self._proxy_sock = None
+        # Wrapping sockets in TLS hides them, close the Tor one explicitly so
+        # that its statistics get back to the instance.
+        if self._tor_sock is not None:
+            self._tor_sock.close()
+            self._tor_sock = None
+        if self._limited_host is not None:
+            self.server.rate_limiter.release(self._limited_host)
+            self._limited_host = None
+        if self._fair_client is not None:
+            self.server.fair_share.release(self._fair_client)
+            self._fair_client = None
+
+    def finish(self):
+        # Intercepted CONNECTs may end without a request.
+        self._close_proxy_sock()
+        ProxyHandler.finish(self)
+
+    def _relay_request(self):
+        """ Stream the client request to the destination. """
+        head = '%s %s %s\r\n%s\r\n' % (self.command, self.path,
+                                       self.request_version, self.headers)
+        # Each request gets its own connection to the destination.
+        head = _end_to_end_head(head, self.headers, Connection='close')
+        view = self._relay_buffer
+        transfer_encoding = self.headers.get('Transfer-Encoding', '')
+        if 'chunked' in transfer_encoding.lower():
+            def relay_body(write, decode):
+                relay_chunked(self.rfile.readline, file_read_into(self.rfile),
+                              write, view, decode)
+        elif 'Content-Length' in self.headers:
+            def relay_body(write, decode):
+                relay_length(file_read_into(self.rfile), write,
+                             int(self.headers['Content-Length']), view)
+        else:
+            relay_body = None
+        self._relay_message('request', head, relay_body,
+                            _upstream(self._proxy_sock.sendall))
+
+    def _relay_response(self):
+        """ Stream the destination response back to the client. """
+        # Unbuffered, so that the socket is positioned right after the
+        # headers once they are parsed.
+        start_time = time()
+        response = HTTPResponse(self._proxy_sock, strict=True,
+                                method=self.command)
+        _upstream(response.begin)()
+        start_time = self._span('first_byte', start_time)
+        self._timings['ttfb'] = start_time - self._request_time
+        self._status = response.status
+        head = '%s %s %s\r\n%s\r\n' % (self.request_version, response.status,
+                                       response.reason, response.msg)
+        view = self._relay_buffer
+        readline = _upstream(response.fp.readline)
+        read_into = _upstream(self._proxy_sock.recv_into)
+        if (self.command == 'HEAD' or response.status in (204, 304)
+                or 100 <= response.status < 200):
+            relay_body = None
+        elif response.chunked:
+            def relay_body(write, decode):
+                relay_chunked(readline, read_into, write, view, decode)
+        elif response.length is not None:
+            def relay_body(write, decode):
+                relay_length(read_into, write, response.length, view)
+        else:
+            def relay_body(write, decode):
+                relay_until_close(read_into, write, view)
+            self.close_connection = 1
+        if self.last_request:
+            connection = 'close'
+        elif self.request_version == 'HTTP/1.0':
+            connection = 'keep-alive'
+        else:
+            connection = None
+        # The Keep-Alive timeout of the destination, for instance, is not
+        # ours.
+        head = _end_to_end_head(head, response.msg, Connection=connection)
+        sendall = self.request.sendall
+        counted = getattr(self.server, 'access_log', None) is not None
+        if counted:
+            self._bytes = 0
+
+        def write(data):
+            self._response_started = True
+            if counted:
+                self._bytes += len(data)
+            sendall(data)
+        try:
+            self._relay_message('response', head, relay_body, write)
+        except IncompleteBody, e:
+            raise UpstreamError(e)
+        self._span('relay', start_time)
+        response.close()
+
+    def _end_request(self):
+        """ Hand the current request to the tracer and the access log. """
+        tracer = getattr(self.server, 'tracer', None)
+        if tracer is not None and self._spans:
+            tracer.add(self._spans)
+        access_log = getattr(self.server, 'access_log', None)
+        if access_log is None:
+            return
+        record = dict((stage, round(seconds, 4))
+                      for stage, seconds in self._timings.iteritems())
+        record.update(
+            time=datetime.utcfromtimestamp(self._request_time).isoformat(),
+            total=round(time() - self._request_time, 4),
+            client=self._client_id or self.client_address[0],
+            instance=getattr(self.tor_instance, 'name', None),
+            method=self.command,
+            destination='%s:%s' % (getattr(self, 'hostname', None),
+                                   getattr(self, 'port', None)),
+            path=self.path,
+            status=self._status,
+            bytes=self._bytes)
+        if self._spans:
+            # Stage, start offset and duration.
+            record['spans'] = [
+                (stage, round(start_time - self._request_time, 4),
+                 round(end_time - start_time, 4))
+                for stage, start_time, end_time in self._spans]
+        access_log.log(record)
+
+    def _relay_message(self, direction, head, relay_body, write):
+        """ Relay a message, through the streaming interceptors if any. """
+        factories = getattr(self.server, '_stream_%s_plugins' % direction, ())
+        interceptors = [factory(self.server, self) for factory in factories]
+        if not interceptors:
+            write(head)
+            if relay_body is not None:
+                relay_body(write, False)
+            return
+
+        # Interceptors may change the body size, so it has to be re-framed.
+        if relay_body is None:
+            write_head, write_body, end_body = write, _ignore, _ignore
+        elif self.request_version != 'HTTP/1.0':
+            def write_head(head):
+                write(_reframe_head(head, chunked=True))
+            write_body, end_body = chunked_writer(write)
+        elif direction == 'response':
+            def write_head(head):
+                write(_reframe_head(head))
+            write_body, end_body = write, _ignore
+            self.close_connection = 1
+        else:
+            # No chunked requests in HTTP/1.0, so the body size must be known.
+            parts = list()
+            write_head = write_body = parts.append
+
+            def end_body():
+                body = ''.join(parts[1:])
+                write(_reframe_head(parts[0], length=len(body)) + body)
+
+        chain = InterceptorChain(interceptors, direction,
+                                 write_head, write_body, end_body)
+        chain.headers(head)
+        if relay_body is not None:
+            relay_body(lambda view: chain.chunk(view.tobytes()), True)
+        chain.end()
 
     def mitm_request(self, data):
         # Register start time
@@ -56,27 +545,109 @@ class TorProxyHandler(ProxyHandler):
         return ProxyHandler.mitm_response(self, data)
 
 
-class DebugInterceptor(RequestInterceptorPlugin, ResponseInterceptorPlugin):
-    def do_request(self, data):
-        print '>> %s' % repr(data[:100])
-        return data
+class DebugInterceptor(StreamRequestInterceptorPlugin,
+                       StreamResponseInterceptorPlugin):
+    def on_request_headers(self, head):
+        print '>> %s' % repr(head[:100])
+        return head
+
+    def on_response_headers(self, head):
+        print '<< %s' % repr(head[:100])
+        return head
+
+
+class TorMitmProxy(AsyncMitmProxy):
+    """ A threaded MITM proxy server that runs streaming interceptors.
+
+    Whole-message miproxy interceptors are also accepted, and run through an
+    adapter.
+
+    CONNECT requests to hosts matching one of the `tunnel_hosts` shell-style
+    patterns are relayed as is instead of being intercepted ('*' tunnels
+    everything). For the others, when `cert_dir` is given the forged
+    certificates are cached there, see proctor.tls.
+
+    Requests are logged to `access_log` if given, see proctor.accesslog,
+    traced by `tracer` if given, see proctor.profiling, and held back by
+    `rate_limiter` and `fair_share` if given, see proctor.ratelimit and
+    proctor.fairshare.
+
+    """
+    daemon_threads = True  # Don't wait for idle keep-alive connections.
+
+    def __init__(self, *args, **kwargs):
+        self.tunnel_hosts = [pattern.lower() for pattern
+                             in kwargs.pop('tunnel_hosts', None) or ()]
+        self.access_log = kwargs.pop('access_log', None)
+        self.tracer = kwargs.pop('tracer', None)
+        self.rate_limiter = kwargs.pop('rate_limiter', None)
+        self.fair_share = kwargs.pop('fair_share', None)
+        cert_dir = kwargs.pop('cert_dir', None)
+        AsyncMitmProxy.__init__(self, *args, **kwargs)
+        self._stream_request_plugins = list()
+        self._stream_response_plugins = list()
+        self.upstream_tls = UpstreamTLS()
+        if cert_dir is not None:
+            self.ca = CertificateCache(self.ca.ca_file, cert_dir)
+
+    def server_close(self):
+        AsyncMitmProxy.server_close(self)
+        log.info('Upstream TLS handshakes (count, avg time): %s'
+                 % self.upstream_tls.stats())
+        if isinstance(self.ca, CertificateCache):
+            log.info('MITM certificate lookups (count, avg time): %s'
+                     % self.ca.stats())
+        if self.tracer is not None:
+            log.info('Traced request stages (count, avg time, max time): %s'
+                     % self.tracer.stats())
+        if self.rate_limiter is not None:
+            for host, stats in sorted(self.rate_limiter.stats().iteritems()):
+                log.info('Host %s: %s' % (host, stats))
+        if self.fair_share is not None:
+            for client_id, stats in sorted(
+                    self.fair_share.stats().iteritems()):
+                log.info('Client %s: %s' % (client_id, stats))
+        scheduler = getattr(self.RequestHandlerClass, 'scheduler', None)
+        if isinstance(scheduler, AffinityScheduler):
+            log.info('Affinity: %s' % scheduler.stats())
+        log.info('Lock contention: %s' % lock_stats())
+
+    def tunnels(self, hostname):
+        """ Tell whether CONNECTs to the host should bypass interception. """
+        hostname = hostname.lower()
+        return any(fnmatch(hostname, pattern) for pattern in self.tunnel_hosts)
+
+    def register_interceptor(self, interceptor_class):
+        if not issubclass(interceptor_class, InterceptorPlugin):
+            raise InvalidInterceptorPluginException(
+                'Expected type InterceptorPlugin got %s instead'
+                % type(interceptor_class))
+        request, response = stream_plugin_factories(interceptor_class)
+        if request is not None:
+            self._stream_request_plugins.append(request)
+        if response is not None:
+            self._stream_response_plugins.append(response)
+
 
-    def do_response(self, data):
-        print '<< %s' % repr(data[:100])
-        return data
+def tor_proxy_handler_factory(tor_swarm, requests_max=None, idle_timeout=None,
+                              pin_instance=False, affinity=None):
+    """ Return a factory for TorProxyHandlers using Tor instances.
 
+    See TorProxyHandler for the meaning of the keyword arguments. With
+    `affinity`, requests are routed by an AffinityScheduler with that key
+    (see proctor.affinity). The scheduler shared by the handlers is
+    available as the factory's `scheduler` attribute.
 
-def tor_proxy_handler_factory(tor_swarm):
-    """ Return a factory for TorProxyHandlers bound to Tor instances. """
-    tor_instances = tor_swarm.instances()
-    generator_lock = Lock()  # Synchronize thread access to the generator.
+    """
+    if affinity is None:
+        scheduler = Scheduler(tor_swarm)
+    else:
+        scheduler = AffinityScheduler(tor_swarm, affinity)
 
     def factory(*args, **kwargs):
-        while True:
-            with generator_lock:
-                tor_instance = next(tor_instances)
-            if tor_instance.connected:
-                break
-        return TorProxyHandler(tor_instance, *args, **kwargs)
+        return TorProxyHandler(scheduler, requests_max=requests_max,
+                               idle_timeout=idle_timeout,
+                               pin_instance=pin_instance, *args, **kwargs)
 
+    factory.scheduler = scheduler
     return factory
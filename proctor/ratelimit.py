@@ -0,0 +1,227 @@
+""" Politeness towards destinations: rate limits and concurrency caps per host.
+
+Spreading requests over Tor circuits does not spread them over destinations:
+a host hammered from every exit we use ends up blocking them all, and the
+errors then get healthy instances restarted. A HostLimiter makes requests to
+a host wait for their turn before an instance is even picked for them.
+
+"""
+import logging
+from fnmatch import fnmatch
+from threading import Condition, Lock
+from time import time
+
+log = logging.getLogger(__name__)
+
+
+class TokenBucket(object):
+    """ Allows `rate` events per second on average, in bursts of `burst`.
+
+    Not thread-safe, the caller synchronizes access.
+
+    """
+    def __init__(self, rate, burst=1, now=None):
+        self.rate = float(rate)
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self._time = time() if now is None else now
+
+    def delay(self, now):
+        """ Return the seconds until a token is available, 0 if one is. """
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self._time) * self.rate)
+        self._time = now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class _Host(object):
+    """ The limits and statistics of a destination host. """
+    def __init__(self, lock, now, rate, burst, concurrency, instance_rate,
+                 instance_burst):
+        self.condition = Condition(lock)
+        self.bucket = TokenBucket(rate, burst, now) if rate else None
+        self.concurrency = concurrency
+        self.instance_rate = instance_rate
+        self.instance_burst = instance_burst
+        self.instance_buckets = dict()
+        self.active = 0
+        self.waiting = 0
+        self.waiting_max = 0
+        self.requests = 0
+        self.queued = 0
+        self.wait_time = 0.0
+        self.wait_max = 0.0
+
+    def delay(self, now):
+        """ Return how long to wait before a request, None for a release. """
+        if self.concurrency and self.active >= self.concurrency:
+            return None
+        if self.bucket is None:
+            return 0
+        return self.bucket.delay(now)
+
+    @property
+    def idle(self):
+        return not (self.active or self.waiting)
+
+
+class HostLimiter(object):
+    """ Queues the requests to each destination host to respect its limits.
+
+    By default each host gets `rate` requests per second with bursts of
+    `burst`, and at most `concurrency` requests in progress at once (None
+    for no limit). `rules` is a list of (host pattern, options) pairs, the
+    options of the first shell-style pattern matching a host replacing the
+    defaults for that host.
+
+    With `instance_rate`, each Tor instance also sends at most that many
+    requests per second to a host, as seen from the host's side each exit
+    is a separate client. Instances over the limit are passed over when
+    picking one (see accept()).
+
+    Requests over the limits wait in acquire() rather than being rejected.
+    The state of hosts without requests in progress is forgotten once there
+    are more than `hosts_max` hosts.
+
+    """
+    def __init__(self, rate=None, burst=1, concurrency=None,
+                 instance_rate=None, instance_burst=1, rules=(),
+                 hosts_max=10000):
+        self.defaults = dict(rate=rate, burst=burst, concurrency=concurrency,
+                             instance_rate=instance_rate,
+                             instance_burst=instance_burst)
+        self.rules = [(pattern.lower(), options) for pattern, options in rules]
+        self.hosts_max = hosts_max
+        self._hosts = dict()
+        self._lock = Lock()
+
+    def _host(self, hostname, now):
+        """ Return the state of a host, creating it if needed at `now`.
+
+        Called with the lock held.
+
+        """
+        host = self._hosts.get(hostname)
+        if host is None:
+            if len(self._hosts) >= self.hosts_max:
+                for name in [n for n, h in self._hosts.iteritems()
+                             if h.idle]:
+                    del self._hosts[name]
+            options = dict(self.defaults)
+            for pattern, rule_options in self.rules:
+                if fnmatch(hostname, pattern):
+                    options.update(rule_options)
+                    break
+            host = self._hosts[hostname] = _Host(self._lock, now, **options)
+        return host
+
+    def acquire(self, hostname):
+        """ Wait until a request to the host is allowed.
+
+        Every acquire() must be followed by a release() once the request is
+        done. Return the time spent waiting.
+
+        """
+        hostname = hostname.lower()
+        start_time = time()
+        with self._lock:
+            host = self._host(hostname, start_time)
+            delay = host.delay(start_time)
+            if delay != 0:
+                host.queued += 1
+                host.waiting += 1
+                host.waiting_max = max(host.waiting_max, host.waiting)
+                try:
+                    while delay != 0:
+                        # Woken up by release(), or when a token is due.
+                        host.condition.wait(delay)
+                        delay = host.delay(time())
+                finally:
+                    host.waiting -= 1
+            if host.bucket is not None:
+                host.bucket.take()
+            host.active += 1
+            host.requests += 1
+            wait_time = time() - start_time
+            host.wait_time += wait_time
+            host.wait_max = max(host.wait_max, wait_time)
+        return wait_time
+
+    def release(self, hostname):
+        """ Let the next request to the host in, the current one is done. """
+        with self._lock:
+            host = self._hosts.get(hostname.lower())
+            if host is None:
+                return
+            host.active -= 1
+            host.condition.notify()
+
+    def accept(self, hostname):
+        """ Return a function telling whether an instance may go to the host.
+
+        The function takes a token from the bucket of the instance for the
+        host when it accepts, so it is meant for Scheduler.pick(). It takes
+        it only once `admit`, if given, has admitted the instance too.
+
+        """
+        hostname = hostname.lower()
+
+        def accept(tor_instance, admit=None):
+            now = time()
+            with self._lock:
+                host = self._host(hostname, now)
+                bucket = None
+                if host.instance_rate:
+                    bucket = host.instance_buckets.get(tor_instance.name)
+                    if bucket is None:
+                        bucket = host.instance_buckets[tor_instance.name] = \
+                            TokenBucket(host.instance_rate,
+                                        host.instance_burst, now)
+                    if bucket.delay(now) > 0:
+                        return False
+                if admit is not None and not admit():
+                    return False
+                if bucket is not None:
+                    bucket.take()
+                return True
+
+        return accept
+
+    def stats(self):
+        """ Return the statistics of each host, in a dict by host name.
+
+        Each value is a dict with the requests in progress and waiting (and
+        the maximum waiting at once), the total requests and those that had
+        to wait, and the average and maximum wait times.
+
+        """
+        with self._lock:
+            return dict(
+                (name, dict(active=host.active, waiting=host.waiting,
+                            waiting_max=host.waiting_max,
+                            requests=host.requests, queued=host.queued,
+                            wait_avg=host.wait_time / (host.requests or 1),
+                            wait_max=host.wait_max))
+                for name, host in self._hosts.iteritems())
+
+
+def parse_rule(value):
+    """ Parse a PATTERN=RATE[,CONCURRENCY] command line rule.
+
+    Return a (pattern, options) rule for HostLimiter. A rate of 0 means no
+    rate limit.
+
+    """
+    pattern, sep, limits = value.partition('=')
+    if not (pattern and sep):
+        raise ValueError('Expected PATTERN=RATE[,CONCURRENCY]: %s' % value)
+    rate, _, concurrency = limits.partition(',')
+    options = dict(rate=float(rate) or None)
+    if concurrency:
+        options['concurrency'] = int(concurrency)
+    return pattern, options
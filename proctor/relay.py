@@ -0,0 +1,262 @@
+""" Bounded-memory relaying of HTTP message bodies.
+
+The functions in this module copy message bodies from a source to a sink
+through a caller-provided, preallocated buffer, so that the memory used by a
+connection does not depend on the size of the messages it carries.
+
+Sources are expressed as ``read_into(view, nbytes)`` callables that behave like
+``socket.recv_into``, and sinks as ``write(data)`` callables that behave like
+``socket.sendall``.
+
+Opaque streams, such as CONNECT tunnels, are relayed in the kernel with
+splice() when possible.
+
+"""
+from __future__ import absolute_import
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import sys
+from select import select
+from socket import SHUT_WR, error as socket_error
+
+log = logging.getLogger(__name__)
+
+BUFFER_SIZE = 64 * 1024
+
+
+class IncompleteBody(IOError):
+    """ The source was closed before the end of the message body. """
+
+
+def file_read_into(fileobj):
+    """ Return a recv_into-like callable reading from a file object.
+
+    Python 2 socket file objects have no readinto(), so the data is copied
+    into the buffer; only one bounded read is alive at any time.
+
+    """
+    def read_into(view, nbytes):
+        data = fileobj.read(nbytes)
+        view[:len(data)] = data
+        return len(data)
+
+    return read_into
+
+
+def relay_length(read_into, write, length, view):
+    """ Relay exactly `length` bytes. """
+    size = len(view)
+    while length > 0:
+        count = read_into(view, min(length, size))
+        if not count:
+            raise IncompleteBody('Connection closed with %d bytes left'
+                                 % length)
+        write(view[:count])
+        length -= count
+
+
+def relay_until_close(read_into, write, view):
+    """ Relay everything until the source closes; return the byte count. """
+    size = len(view)
+    total = 0
+    while True:
+        count = read_into(view, size)
+        if not count:
+            return total
+        write(view[:count])
+        total += count
+
+
+def relay_chunked(readline, read_into, write, view, decode=False):
+    """ Relay a chunked body, verbatim or decoded.
+
+    Chunk-size lines and trailers are read with `readline`, which must not
+    read ahead of the line (e.g. an unbuffered socket file object), while the
+    chunk payloads go through the buffer. When `decode` is true only the
+    payload is written out, without the chunked framing and trailers.
+
+    """
+    while True:
+        line = readline()
+        if not line:
+            raise IncompleteBody('Connection closed in chunked body')
+        if not decode:
+            write(line)
+        try:
+            chunk_size = int(line.split(';', 1)[0].strip(), 16)
+        except ValueError:
+            raise IncompleteBody('Invalid chunk size line %r' % line[:40])
+        if chunk_size == 0:
+            break
+        if decode:
+            relay_length(read_into, write, chunk_size, view)
+            readline()  # Chunk data CRLF.
+        else:
+            relay_length(read_into, write, chunk_size + 2, view)  # With CRLF.
+    # Trailers, if any, up to and including the terminating empty line.
+    while True:
+        line = readline()
+        if not line:
+            raise IncompleteBody('Connection closed in chunked trailer')
+        if not decode:
+            write(line)
+        if line in ('\r\n', '\n'):
+            break
+
+
+def chunked_writer(write):
+    """ Return write() and end() callables producing a chunked body. """
+    def write_chunk(data):
+        if len(data):
+            write('%x\r\n%s\r\n' % (len(data), data))
+
+    def end():
+        write('0\r\n\r\n')
+
+    return write_chunk, end
+
+
+def _load_splice():
+    """ Return a splice(src, dst, count, flags) function, or None.
+
+    Uses os.splice when the interpreter has it, and otherwise calls the libc
+    function through ctypes when on Linux.
+
+    """
+    if hasattr(os, 'splice'):
+        return os.splice
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        libc_splice = libc.splice
+    except (AttributeError, OSError):
+        return None
+    libc_splice.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+                            ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+    libc_splice.restype = ctypes.c_ssize_t
+
+    def splice(src, dst, count, flags=0):
+        result = libc_splice(src, None, dst, None, count, flags)
+        if result < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        return result
+
+    return splice
+
+_splice = _load_splice()
+SPLICE_F_MOVE = 1
+SPLICE_F_NONBLOCK = 2
+
+
+def tunnel(sock_a, sock_b, view, idle_timeout=None):
+    """ Relay bytes both ways between two sockets until both ends are done.
+
+    The data is moved with splice() through pipes when available, so that it
+    never gets copied to user space, and through the buffer otherwise.
+    Return early when nothing happened for `idle_timeout` seconds.
+
+    """
+    global _splice
+    peers = {sock_a: sock_b, sock_b: sock_a}
+
+    def make_pumps(sockets):
+        if _splice is not None:
+            return dict((s, _SplicePump(s, peers[s])) for s in sockets)
+        return dict((s, _BufferPump(s, peers[s], view)) for s in sockets)
+
+    pumps = make_pumps(peers)
+    try:
+        while pumps:
+            readable = select(list(pumps), [], [], idle_timeout)[0]
+            if not readable:
+                log.debug('Tunnel idle for %ss, closing' % idle_timeout)
+                return
+            for src in readable:
+                try:
+                    count = pumps[src]()
+                except _SpliceUnsupported:
+                    log.debug('splice() not supported, using buffers')
+                    _splice = None
+                    for pump in pumps.values():
+                        pump.close()
+                    pumps = make_pumps(pumps)
+                    break
+                if not count:
+                    # Half-close: propagate the EOF, keep the other way open.
+                    pumps.pop(src).close()
+                    try:
+                        peers[src].shutdown(SHUT_WR)
+                    except socket_error:
+                        pass
+    finally:
+        for pump in pumps.values():
+            pump.close()
+
+
+class _SpliceUnsupported(Exception):
+    pass
+
+
+class _BufferPump(object):
+    """ Move data from a socket to another through a user space buffer. """
+    def __init__(self, src, dst, view):
+        self.src = src
+        self.dst = dst
+        self.view = view
+
+    def __call__(self):
+        count = self.src.recv_into(self.view)
+        if count:
+            self.dst.sendall(self.view[:count])
+        return count
+
+    def close(self):
+        pass
+
+
+class _SplicePump(object):
+    """ Move data from a socket to another through a pipe, in the kernel.
+
+    The pipe is always drained before returning, so that it is safe to switch
+    to a _BufferPump at any time between two calls.
+
+    """
+    chunk_size = 64 * 1024
+
+    def __init__(self, src, dst):
+        self.splice = _splice
+        self.src = src.fileno()
+        self.dst = dst
+        self.pipe_r, self.pipe_w = os.pipe()
+
+    def __call__(self):
+        try:
+            count = self.splice(self.src, self.pipe_w, self.chunk_size,
+                            flags=SPLICE_F_MOVE | SPLICE_F_NONBLOCK)
+        except OSError, e:
+            if e.errno == errno.EAGAIN:
+                return True  # Spurious wake up.
+            if e.errno in (errno.EINVAL, errno.ENOSYS):
+                raise _SpliceUnsupported()
+            raise
+        pending = count
+        while pending:
+            try:
+                pending -= self.splice(self.pipe_r, self.dst.fileno(), pending,
+                                   flags=SPLICE_F_MOVE)
+            except OSError, e:
+                if e.errno != errno.EAGAIN:
+                    raise
+                select([], [self.dst], [])  # Non-blocking due to a timeout.
+        return count
+
+    def close(self):
+        os.close(self.pipe_r)
+        os.close(self.pipe_w)
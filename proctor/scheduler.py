@@ -0,0 +1,104 @@
+""" Selection of the Tor instance that will carry a request. """
+
+from threading import Lock
+from time import sleep
+
+from proctor.profiling import TimedLock
+
+
+class Scheduler(object):
+    """ Hands out connected Tor instances in a round-robin fashion.
+
+    A scheduler is shared by all the proxy handlers, each request asking for
+    an instance with pick(). Instances whose health policy does not admit
+    requests are skipped.
+
+    """
+    def __init__(self, tor_swarm):
+        self.tor_swarm = tor_swarm
+        self._instances = tor_swarm.instances()
+        # Synchronize thread access to the generator.
+        self._lock = TimedLock('scheduler')
+        self._waiting = 0
+        self._waiting_lock = Lock()
+
+    @property
+    def waiting(self):
+        """ Return the number of requests waiting for a connected instance.
+
+        Requests that only the `accept` function of pick() refuses are not
+        counted: more instances would not serve them sooner.
+
+        """
+        return self._waiting
+
+    def _set_waiting(self, increment):
+        with self._waiting_lock:
+            self._waiting += increment
+
+    def admits(self, tor_instance, accept=None):
+        """ Tell whether the instance may take a new request right now.
+
+        It must be connected, neither being removed nor terminated, and
+        admitted by its health policy, which may count the request as a trial
+        (see proctor.health). If given, `accept` is called with the instance
+        and the admit() method of its health policy: it calls it once it
+        would accept the instance itself, so that neither side counts a
+        request the other refuses.
+
+        """
+        return self.refusal(tor_instance, accept) is None
+
+    def refusal(self, tor_instance, accept=None):
+        """ Return why the instance may not take a new request, or None.
+
+        The reason is 'unavailable' when it is not connected, being removed
+        or terminated, 'health' when its health policy refuses the request,
+        and 'accept' when only `accept` does, see admits().
+
+        """
+        if not (tor_instance.connected and not tor_instance.draining
+                and not tor_instance.terminated):
+            return 'unavailable'
+        if accept is None:
+            return None if tor_instance.health.admit() else 'health'
+        admitted = list()
+
+        def admit():
+            admitted.append(tor_instance.health.admit())
+            return admitted[-1]
+        if accept(tor_instance, admit):
+            return None
+        return 'health' if admitted and not admitted[-1] else 'accept'
+
+    def pick(self, accept=None):
+        """ Return the next connected Tor instance.
+
+        If given, `accept` is called with the candidate instances and those
+        it returns false for are skipped, see admits().
+
+        """
+        waited = False
+        misses = 0
+        try:
+            while True:
+                with self._lock:
+                    tor_instance = next(self._instances)
+                reason = 'unavailable'
+                if tor_instance is not None:
+                    reason = self.refusal(tor_instance, accept)
+                    if reason is None:
+                        return tor_instance
+                if not waited and reason != 'accept':
+                    waited = True
+                    self._set_waiting(1)
+                misses += 1
+                if (tor_instance is None
+                        or misses >= len(self.tor_swarm.members())):
+                    # A whole round without luck, circuit breakers may stay
+                    # open for a while: do not spin.
+                    misses = 0
+                    sleep(0.05)
+        finally:
+            if waited:
+                self._set_waiting(-1)
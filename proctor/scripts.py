@@ -3,65 +3,219 @@
 import logging
 import sys
 from argparse import ArgumentParser
+from os import path
 from shutil import rmtree
 from tempfile import mkdtemp
 from time import sleep
 
-from miproxy.proxy import AsyncMitmProxy
-
 from proctor.vendor.exit import handle_exit
 
 LOG_FORMAT = '%(asctime)s,%(msecs)03d %(levelname)-5.5s [%(name)s] %(message)s'
 
 
+def add_swarm_arguments(parser, instances):
+    """ Add the options of the Tor processes, see swarm_options().
+
+    Return the argument group, for callers to add their own options.
+
+    """
+    group = parser.add_argument_group('Tor processes')
+    group.add_argument('-d', '--work-dir', help='Working directory')
+    group.add_argument('-s', '--base-socks-port', type=int, default=19050,
+                       help='Base socks port for the Tor processes')
+    group.add_argument('-c', '--base-control-port', type=int, default=18118,
+                       help='Base control port for the Tor processes')
+    group.add_argument('-n', '--instances', type=int, default=instances,
+                       help='Number of Tor processes to launch')
+    group.add_argument('-m', '--max-use', type=int,
+                       help='Max number of requests before replacing '
+                            'Tor processes')
+    group.add_argument('-t', '--max-conn-time', type=float, default=2,
+                       help='Average connection time beyond which Tor '
+                            'processes are considered unhealthy')
+    group.add_argument('--dir-cache',
+                       default=path.join(path.expanduser('~'), '.cache',
+                                         'proctor', 'tor-directory'),
+                       help='Directory where Tor directory documents are '
+                            'kept between runs, to speed up bootstrapping')
+    group.add_argument('--no-dir-cache', action='store_true',
+                       help='Let each Tor process fetch the directory '
+                            'documents on its own')
+    group.add_argument('--unix-sockets', action='store_true',
+                       help='Talk to the Tor processes over Unix domain '
+                            'sockets in the work dir instead of TCP ports')
+    group.add_argument('--socks4', action='store_true',
+                       help='Talk SOCKS4 to the Tor processes, which waits '
+                            'for the destination to be connected before '
+                            'sending requests')
+    group.add_argument('--circuit-breaker', action='store_true',
+                       help='Stop sending requests to struggling Tor '
+                            'processes for a while before restarting them')
+    return group
+
+
+def swarm_options(args):
+    """ Return the TorSwarm keyword arguments given on the command line. """
+    from .dircache import DirectoryCache
+    from .health import CircuitBreaker, RestartPolicy
+    dir_cache = None if args.no_dir_cache else DirectoryCache(args.dir_cache)
+    health_policy = CircuitBreaker if args.circuit_breaker else RestartPolicy
+    return dict(dir_cache=dir_cache, unix_sockets=args.unix_sockets,
+                socks5=not args.socks4, health_policy=health_policy,
+                conn_time_avg_max=args.max_conn_time)
+
+
+def add_loglevel_argument(parser):
+    parser.add_argument('-l', '--loglevel', default='INFO',
+                        choices=('CRITICAL', 'ERROR', 'WARN', 'INFO', 'DEBUG'),
+                        help='Display messages above this log level')
+
+
+def add_rate_limit_arguments(parser):
+    from .ratelimit import parse_rule
+    group = parser.add_argument_group(
+        'rate limits', 'Limits of the requests to each destination host. '
+        'Requests over the limits wait for their turn.')
+    group.add_argument('--host-rate', type=float,
+                       help='Requests per second to any host')
+    group.add_argument('--host-burst', type=int, default=1,
+                       help='Requests allowed in a burst above the rate')
+    group.add_argument('--host-concurrency', type=int,
+                       help='Requests in progress at once to any host')
+    group.add_argument('--host-instance-rate', type=float,
+                       help='Requests per second to any host through each '
+                            'Tor process')
+    group.add_argument('--host-limit', type=parse_rule, action='append',
+                       default=[], metavar='PATTERN=RATE[,CONCURRENCY]',
+                       help='Limits of the hosts matching a shell-style '
+                            'pattern, instead of the above (a rate of 0 for '
+                            'none); can be repeated')
+
+
+def rate_limit_options(args):
+    """ Return the HostLimiter options given on the command line, or None. """
+    if not (args.host_rate or args.host_concurrency or args.host_limit
+            or args.host_instance_rate):
+        return None
+    return dict(rate=args.host_rate, burst=args.host_burst,
+                concurrency=args.host_concurrency,
+                instance_rate=args.host_instance_rate,
+                instance_burst=args.host_burst, rules=args.host_limit)
+
+
 def get_args_parser():
-    parser = ArgumentParser(description=__doc__)
-    parser.add_argument('-d', '--work-dir', help='Working directory')
+    parser = ArgumentParser(description=__doc__,
+                            epilog='Run "proctor fetch --help" to fetch lists '
+                                   'of urls instead.')
     parser.add_argument('-p', '--port', type=int, default=8080,
                         help='Proxy server listening port')
-    parser.add_argument('-s', '--base-socks-port', type=int, default=19050,
-                        help='Base socks port for the Tor processes')
-    parser.add_argument('-c', '--base-control-port', type=int, default=18118,
-                        help='Base control port for the Tor processes')
-    parser.add_argument('-n', '--instances', type=int, default=2,
-                        help='Number of Tor processes to launch')
-    parser.add_argument('-m', '--max-use', type=int,
-                        help='Max number of requests before replacing '
-                             'Tor processes')
-    parser.add_argument('-t', '--max-conn-time', type=float, default=2,
-                        help='Number of Tor processes to launch')
+    group = add_swarm_arguments(parser, instances=2)
+    group.add_argument('--min-instances', type=int,
+                       help='Let the number of Tor processes shrink down to '
+                            'this under low load')
+    group.add_argument('--max-instances', type=int,
+                       help='Let the number of Tor processes grow up to '
+                            'this under high load')
+    group.add_argument('--instance-load', type=float, default=8,
+                       help='Target number of concurrent connections per '
+                            'Tor process when autoscaling, at most the '
+                            '--fair-share slots')
+    parser.add_argument('-k', '--keep-alive-max', type=int, default=100,
+                        help='Max number of requests per client connection '
+                             '(0 for no limit)')
+    parser.add_argument('-i', '--idle-timeout', type=float, default=30,
+                        help='Seconds before closing idle client connections')
+    parser.add_argument('--pin-instance', action='store_true',
+                        help='Send all the requests of a client connection '
+                             'through the same Tor process')
+    parser.add_argument('--affinity', metavar='KEY',
+                        help='Send the requests with the same key through '
+                             'the same Tor process while it is available; '
+                             'KEY is "host", "cookie:NAME" or "header:NAME"')
+    parser.add_argument('-a', '--access-log', metavar='FILE',
+                        help='Log requests to this file, as JSON lines')
+    parser.add_argument('--access-log-max-size', type=int, default=100,
+                        metavar='MB',
+                        help='Size beyond which the access log is rotated')
+    parser.add_argument('--trace-rate', type=float, default=0,
+                        help='Fraction of the requests whose stages are '
+                             'traced (e.g. 0.01)')
+    parser.add_argument('--profile-duration', type=float, default=30,
+                        help='Seconds to profile for on SIGUSR1')
+    parser.add_argument('--profile-dir', default='.',
+                        help='Directory where profiles are written')
+    parser.add_argument('-T', '--tunnel', action='append', default=[],
+                        metavar='HOST_PATTERN',
+                        help='Relay HTTPS to matching hosts without '
+                             'decrypting it (e.g. "*.example.com", or "*" '
+                             'for all hosts); can be repeated')
+    add_rate_limit_arguments(parser)
+    from .fairshare import parse_client
+    group = parser.add_argument_group(
+        'fair share', 'Share the Tor processes between clients by weighted '
+        'fair queuing.')
+    group.add_argument('--fair-share', type=int, metavar='SLOTS',
+                       help='Requests in progress per connected Tor process, '
+                            'beyond which requests wait for their turn')
+    group.add_argument('--client-id', choices=('address', 'user'),
+                       default='address',
+                       help='Identify clients by address, or by their '
+                            'Proxy-Authorization user name')
+    group.add_argument('--client', type=parse_client, action='append',
+                       default=[], metavar='CLIENT=WEIGHT[,QUOTA]',
+                       help='Weight and maximum requests in progress of a '
+                            'client; can be repeated')
+    group.add_argument('--client-quota', type=int,
+                       help='Maximum requests in progress of other clients')
     return parser
 
 
 def parse_args():
     parser = get_args_parser()
-    parser.add_argument('-l', '--loglevel', default='INFO',
-                        choices=('CRITICAL', 'ERROR', 'WARN', 'INFO', 'DEBUG'),
-                        help='Display messages above this log level')
-    return parser.parse_args()
+    add_loglevel_argument(parser)
+    args = parser.parse_args()
+    if args.fair_share is not None and args.fair_share < 1:
+        parser.error('--fair-share needs at least one slot')
+    return args
 
 
 def run_proxy(port, base_socks_port, base_control_port, work_dir,
-              num_instances, sockets_max, **kwargs):
+              num_instances, sockets_max, tunnel_hosts=None,
+              handler_options=None, autoscale_options=None,
+              access_log_options=None, trace_rate=0, profile_options=None,
+              rate_limit_options=None, fair_share_options=None, **kwargs):
     # Imported here so that the logging module could be initialized by another
     # script that would import from the present module. Not sure that's the
     # best way to accomplish this though.
+    from .accesslog import AccessLog
+    from .affinity import AffinityScheduler
+    from .autoscale import Autoscaler
+    from .fairshare import FairShare
+    from .profiling import Tracer, profile_on_signal
+    from .ratelimit import HostLimiter
     from .tor import TorSwarm
-    from .proxy import tor_proxy_handler_factory
+    from .proxy import TorMitmProxy, tor_proxy_handler_factory
 
     log = logging.getLogger(__name__)
 
     proxy = None
     tor_swarm = None
+    autoscaler = None
+    access_log = None
 
     def kill_handler():
         log.warn('Interrupted, stopping server')
         try:
+            if autoscaler is not None:
+                autoscaler.stop()
             if proxy:
                 proxy.server_close()
         finally:
             if tor_swarm is not None:
                 tor_swarm.stop()
+            if access_log is not None:
+                access_log.stop()
+                access_log.join()
 
     with handle_exit(kill_handler):
         tor_swarm = TorSwarm(base_socks_port, base_control_port, work_dir,
@@ -73,22 +227,99 @@ def run_proxy(port, base_socks_port, base_control_port, work_dir,
                 log.critical('No alive Tor instance left. Bailing out.')
                 sys.exit(1)
             sleep(0.25)
-        handler_factory = tor_proxy_handler_factory(tor_swarm)
-        proxy = AsyncMitmProxy(server_address=('', port),
-                               RequestHandlerClass=handler_factory)
+        handler_factory = tor_proxy_handler_factory(tor_swarm,
+                                                    **handler_options or {})
+        fair_share = None
+        if fair_share_options:
+            fair_share_options = dict(fair_share_options)
+            slots = fair_share_options.pop('slots')
+
+            def capacity():
+                return slots * len([t for t in tor_swarm.members()
+                                    if t.connected])
+
+            fair_share = FairShare(capacity, **fair_share_options)
+        if autoscale_options:
+            autoscaler = Autoscaler(tor_swarm, handler_factory.scheduler,
+                                    fair_share=fair_share,
+                                    **autoscale_options)
+            autoscaler.start()
+        if access_log_options:
+            access_log = AccessLog(**access_log_options)
+            access_log.start()
+        tracer = Tracer(trace_rate) if trace_rate else None
+        rate_limiter = None
+        if rate_limit_options:
+            rate_limiter = HostLimiter(**rate_limit_options)
+        if profile_options:
+            stats = dict()
+            if rate_limiter is not None:
+                stats['Host'] = rate_limiter.stats
+            if fair_share is not None:
+                stats['Client'] = fair_share.stats
+            scheduler = handler_factory.scheduler
+            if isinstance(scheduler, AffinityScheduler):
+                stats['Affinity'] = scheduler.stats
+            profile_on_signal(tracer=tracer, stats=stats, **profile_options)
+        proxy = TorMitmProxy(server_address=('', port),
+                             RequestHandlerClass=handler_factory,
+                             tunnel_hosts=tunnel_hosts,
+                             access_log=access_log, tracer=tracer,
+                             rate_limiter=rate_limiter,
+                             fair_share=fair_share,
+                             cert_dir=path.join(work_dir, 'certs'))
         log.info('Starting proxy server on port %s' % port)
         proxy.serve_forever()
 
 
 def main():
+    if sys.argv[1:2] == ['fetch']:
+        from .bulk import main as fetch_main
+        return fetch_main(sys.argv[2:])
     args = parse_args()
+    autoscale_options = None
+    if args.min_instances is not None or args.max_instances is not None:
+        autoscale_options = dict(
+            min_instances=min(args.instances, args.instances
+                              if args.min_instances is None
+                              else args.min_instances),
+            max_instances=max(args.instances, args.instances
+                              if args.max_instances is None
+                              else args.max_instances),
+            # Instances never get more requests than the fair share slots.
+            target_load=min(args.instance_load, args.instance_load
+                            if args.fair_share is None else args.fair_share),
+            latency_high=args.max_conn_time / 2.0)
+    access_log_options = None
+    if args.access_log:
+        access_log_options = dict(
+            filename=args.access_log,
+            max_bytes=args.access_log_max_size * 1024 * 1024)
+    fair_share_options = None
+    if args.fair_share is not None:
+        fair_share_options = dict(slots=args.fair_share,
+                                  clients=args.client,
+                                  quota=args.client_quota,
+                                  by_user=args.client_id == 'user')
     work_dir = args.work_dir or mkdtemp()
     logging.basicConfig(level=getattr(logging, args.loglevel),
                         format=LOG_FORMAT)
     try:
         run_proxy(args.port, args.base_socks_port, args.base_control_port,
                   work_dir, args.instances, args.max_use,
-                  conn_time_avg_max=args.max_conn_time)
+                  tunnel_hosts=args.tunnel,
+                  handler_options=dict(requests_max=args.keep_alive_max,
+                                       idle_timeout=args.idle_timeout,
+                                       pin_instance=args.pin_instance,
+                                       affinity=args.affinity),
+                  autoscale_options=autoscale_options,
+                  access_log_options=access_log_options,
+                  trace_rate=args.trace_rate,
+                  rate_limit_options=rate_limit_options(args),
+                  fair_share_options=fair_share_options,
+                  profile_options=dict(duration=args.profile_duration,
+                                       output_dir=args.profile_dir),
+                  **swarm_options(args))
     finally:
         if not args.work_dir:
             rmtree(work_dir)
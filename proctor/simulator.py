@@ -0,0 +1,345 @@
+""" A discrete-event simulator of a Tor swarm behind the proxy.
+
+The health logic of TorProcess and the Scheduler are the real ones, but no
+Tor process is run: time is virtual, and connection times and failures come
+from a trace, either a synthetic model of Tor circuits or records replayed
+from an access log (see proctor.accesslog). An hour of traffic takes seconds
+to simulate, so health settings can be compared quickly:
+
+    python -m proctor.simulator --errors-max 5 10 20 --grace-time 30 120
+
+Each option given several values is tried with every value of the others.
+Health policies can be compared the same way, with `--policy restart breaker`.
+
+Simulations are deterministic for a given seed. The regression tests of the
+health policies in tests/test_simulator.py run a few of them.
+
+"""
+import heapq
+import itertools
+import json
+import logging
+import random
+import sys
+from argparse import ArgumentParser
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from proctor.health import CircuitBreaker, RestartPolicy
+from proctor.scheduler import Scheduler
+from proctor.tor import TorProcess, TorSwarm
+
+log = logging.getLogger(__name__)
+
+POLICIES = dict(restart=RestartPolicy, breaker=CircuitBreaker)
+
+
+class SyntheticTrace(object):
+    """ Connection times and failures drawn from a simple model of circuits.
+
+    Each boot of an instance gets circuits that are bad with a probability of
+    `bad_rate`. Good circuits connect in an exponentially distributed time of
+    mean `latency`, and fail with a probability of `error_rate`; bad ones use
+    `bad_latency` and `bad_error_rate`. Any instance also goes through
+    hiccups, starting `hiccup_rate` times per second on average and lasting
+    `hiccup_duration` seconds, during which it behaves like a bad one.
+
+    Failed connections take `timeout` seconds, and boots take `boot_time`
+    seconds give or take half.
+
+    """
+    def __init__(self, latency=0.8, error_rate=0.02, bad_rate=0.1,
+                 bad_latency=5, bad_error_rate=0.5, hiccup_rate=1 / 600.0,
+                 hiccup_duration=20, timeout=10, boot_time=20):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.bad_rate = bad_rate
+        self.bad_latency = bad_latency
+        self.bad_error_rate = bad_error_rate
+        self.hiccup_rate = hiccup_rate
+        self.hiccup_duration = hiccup_duration
+        self.timeout = timeout
+        self.boot_time = boot_time
+        self._states = dict()
+
+    def boot(self, tor, now, rng):
+        """ Return how long a boot of the instance takes. """
+        self._states[tor.name] = dict(
+            bad=rng.random() < self.bad_rate, hiccup_end=0,
+            next_hiccup=now + self._hiccup_interval(rng))
+        return self.boot_time * rng.uniform(0.5, 1.5)
+
+    def _hiccup_interval(self, rng):
+        if not self.hiccup_rate:
+            return float('inf')
+        return rng.expovariate(self.hiccup_rate)
+
+    def sample(self, tor, now, rng):
+        """ Return the (time, failed) of a connection through the instance. """
+        state = self._states[tor.name]
+        while state['next_hiccup'] <= now:
+            state['hiccup_end'] = state['next_hiccup'] + self.hiccup_duration
+            state['next_hiccup'] = (state['hiccup_end']
+                                    + self._hiccup_interval(rng))
+        if state['bad'] or now < state['hiccup_end']:
+            latency, error_rate = self.bad_latency, self.bad_error_rate
+        else:
+            latency, error_rate = self.latency, self.error_rate
+        if rng.random() < error_rate:
+            return self.timeout, True
+        return rng.expovariate(1.0 / latency), False
+
+
+class RecordedTrace(object):
+    """ Connection times and failures replayed from access log records.
+
+    The records of each recorded instance are replayed in order, and cycled
+    through. Simulated instances are mapped to recorded ones by slot number.
+    Requests that got no response count as failed, taking their total time.
+
+    """
+    def __init__(self, records, boot_time=20):
+        self.boot_time = boot_time
+        samples = defaultdict(list)
+        for record in records:
+            if not record.get('instance'):
+                continue
+            failed = record.get('status') is None or record['status'] >= 500
+            seconds = record.get('connect', record.get('total', 0))
+            samples[record['instance']].append((seconds, failed))
+        if not samples:
+            raise ValueError('No usable records')
+        self._samples = [samples[name] for name in sorted(samples)]
+        self._positions = dict()
+
+    @classmethod
+    def from_file(cls, filename, **kwargs):
+        """ Read the records of an access log file. """
+        with open(filename) as f:
+            return cls((json.loads(line) for line in f if line.strip()),
+                       **kwargs)
+
+    def boot(self, tor, now, rng):
+        return self.boot_time * rng.uniform(0.5, 1.5)
+
+    def sample(self, tor, now, rng):
+        samples = self._samples[tor.slot % len(self._samples)]
+        position = self._positions.get(tor.name, 0)
+        self._positions[tor.name] = position + 1
+        return samples[position % len(samples)]
+
+
+class _VirtualTor(object):
+    """ Stands for the Tor process of a SimulatedTorProcess. """
+    def __init__(self, tor_process):
+        self.tor_process = tor_process
+
+    def start(self):
+        self.tor_process.generation += 1
+        self.tor_process.simulation.boot(self.tor_process)
+
+
+class SimulatedTorProcess(TorProcess):
+    """ A TorProcess that boots and restarts in virtual time.
+
+    Each (re)start begins a new generation, sockets of older generations do
+    not count in the statistics.
+
+    """
+    def __init__(self, *args, **kwargs):
+        self.simulation = kwargs.pop('simulation')
+        super(SimulatedTorProcess, self).__init__(*args, **kwargs)
+        self.clock = self.simulation.clock
+        self.generation = 0
+
+    def start(self):
+        self._start(_VirtualTor(self))
+
+    def stop(self):
+        pass
+
+    def _restart(self, tor, failed_boot=False, died=False):
+        # Unlike the real one, does not wait for the open sockets.
+        self._connected.clear()
+        self._start(tor)
+
+    def create_socket(self, suppress_errors=False, *args, **kwargs):
+        if not self.connected:
+            return None
+        self._inc_ref_count()
+        self._inc_socket_count()
+        return self.generation
+
+
+class SimulatedTorSwarm(TorSwarm):
+    process_class = SimulatedTorProcess
+
+    def start(self, num_instances):
+        return [self.add_instance() for _ in range(num_instances)]
+
+
+class Simulation(object):
+    """ Runs requests arriving at `rate` per second through a swarm.
+
+    The swarm has `instances` Tor processes, created with the keyword
+    arguments left (errors_max, grace_time, health_policy...). Requests wait
+    for an available instance when there is none. Every second each connected
+    instance has its health checked, like TorProcess.monitor() does.
+
+    """
+    epoch = datetime(2000, 1, 1)
+
+    def __init__(self, trace, instances=4, rate=20, duration=3600, seed=0,
+                 **tor_options):
+        self.trace = trace
+        self.instances = instances
+        self.rate = rate
+        self.duration = duration
+        self.rng = random.Random(seed)
+        self.sockets_max = tor_options.pop('sockets_max', None)
+        self.tor_options = tor_options
+        self.now = 0.0
+        self._events = list()
+        self._sequence = itertools.count()
+
+    def clock(self):
+        """ Return the virtual time, as a datetime. """
+        return self.epoch + timedelta(seconds=self.now)
+
+    def schedule(self, delay, callback, *args):
+        heapq.heappush(self._events, (self.now + delay, next(self._sequence),
+                                      callback, args))
+
+    def boot(self, tor):
+        self.boots += 1
+        self.schedule(self.trace.boot(tor, self.now, self.rng),
+                      self._booted, tor, tor.generation)
+
+    def _booted(self, tor, generation):
+        if tor.generation == generation:
+            tor._start_time = self.clock()
+            tor._connected.set()
+
+    def run(self):
+        """ Run the simulation, and return a dict of results. """
+        self.boots = 0
+        self.restarts = defaultdict(int)
+        self.latencies = list()
+        self.waits = list()
+        self.failed = 0
+        self.swarm = SimulatedTorSwarm(0, 0, '', self.sockets_max,
+                                       simulation=self, **self.tor_options)
+        self.swarm.start(self.instances)
+        self.scheduler = Scheduler(self.swarm)
+        self.schedule(self.rng.expovariate(self.rate), self._arrival)
+        self.schedule(1, self._check_health)
+        while self._events:
+            time, _, callback, args = heapq.heappop(self._events)
+            if time > self.duration:
+                break
+            self.now = time
+            callback(*args)
+        return self.results()
+
+    def _arrival(self):
+        self._dispatch(self.now)
+        self.schedule(self.rng.expovariate(self.rate), self._arrival)
+
+    def _dispatch(self, arrival_time):
+        if not [i for i in self.swarm.members() if i.available]:
+            self.schedule(0.1, self._dispatch, arrival_time)
+            return
+        tor = self.scheduler.pick()
+        generation = tor.create_socket()
+        seconds, failed = self.trace.sample(tor, self.now, self.rng)
+        self.schedule(seconds, self._complete, tor, generation, arrival_time,
+                      seconds, failed)
+
+    def _complete(self, tor, generation, arrival_time, seconds, failed):
+        if tor.generation == generation:
+            tor._receive_stats(seconds, int(failed))
+        else:
+            tor._dec_ref_count()
+        if failed:
+            self.failed += 1
+        else:
+            self.latencies.append(self.now - arrival_time)
+            self.waits.append(self.now - arrival_time - seconds)
+
+    def _check_health(self):
+        for tor in self.swarm.members():
+            if tor.connected:
+                reason = tor.check_health()
+                if reason is not None:
+                    self.restarts[reason] += 1
+                    tor._restart(_VirtualTor(tor))
+        self.schedule(1, self._check_health)
+
+    def results(self):
+        latencies = sorted(self.latencies)
+
+        def percentile(fraction):
+            if not latencies:
+                return None
+            return latencies[int((len(latencies) - 1) * fraction)]
+
+        return dict(
+            completed=len(latencies), failed=self.failed,
+            throughput=len(latencies) / float(self.duration),
+            p50=percentile(0.5), p90=percentile(0.9), p99=percentile(0.99),
+            wait_avg=sum(self.waits) / (len(self.waits) or 1),
+            boots=self.boots, restarts=dict(self.restarts))
+
+
+def get_args_parser():
+    parser = ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-n', '--instances', type=int, default=4,
+                        help='Number of Tor processes')
+    parser.add_argument('-r', '--rate', type=float, default=20,
+                        help='Requests per second')
+    parser.add_argument('--duration', type=float, default=3600,
+                        help='Simulated seconds')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed, runs with the same one are equal')
+    parser.add_argument('--trace', metavar='ACCESS_LOG',
+                        help='Replay the connection times and failures of '
+                             'an access log instead of using the synthetic '
+                             'model')
+    parser.add_argument('--errors-max', type=int, nargs='+', default=[10])
+    parser.add_argument('--conn-time-avg-max', type=float, nargs='+',
+                        default=[2])
+    parser.add_argument('--grace-time', type=float, nargs='+', default=[30])
+    parser.add_argument('--sockets-max', type=int, nargs='+', default=[None])
+    parser.add_argument('--stats-window', type=int, nargs='+', default=[200])
+    parser.add_argument('--policy', nargs='+', choices=sorted(POLICIES),
+                        default=['restart'], help='Health policies')
+    return parser
+
+
+def main(argv=None):
+    args = get_args_parser().parse_args(argv)
+    logging.basicConfig(level=logging.WARN)
+    names = ('errors_max', 'conn_time_avg_max', 'grace_time', 'sockets_max',
+             'stats_window', 'policy')
+    print ('%7s %7s %6s %6s %6s %5s  %s'
+           % ('req/s', 'failed', 'p50', 'p90', 'p99', 'boots',
+              'configuration, restarts'))
+    for values in itertools.product(*(getattr(args, n) for n in names)):
+        options = dict(zip(names, values))
+        options['health_policy'] = POLICIES[options.pop('policy')]
+        if args.trace:
+            trace = RecordedTrace.from_file(args.trace)
+        else:
+            trace = SyntheticTrace()
+        results = Simulation(trace, args.instances, args.rate, args.duration,
+                             args.seed, **options).run()
+        print ('%7.2f %7d %6.2f %6.2f %6.2f %5d  %s %s'
+               % (results['throughput'], results['failed'],
+                  results['p50'] or 0, results['p90'] or 0,
+                  results['p99'] or 0, results['boots'],
+                  ' '.join('%s=%s' % (n, v) for n, v in zip(names, values)),
+                  results['restarts']))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,5 +1,10 @@
+from __future__ import absolute_import
+
+import struct
 from contextlib import contextmanager
 from datetime import datetime
+from socket import (
+    AF_INET, AF_INET6, AF_UNIX, error as socket_error, inet_pton)
 
 import socks
 
@@ -8,7 +13,8 @@ class InstrumentedSocket(socks.socksocket):
     """ A socket that maintains timing info about connection/disconnection.
 
     The timing info will be sent back once to the callback on either socket
-    shutdown(), close(), or on any error.
+    shutdown(), close(), or on any error, along with the code of the SOCKS5
+    error reply if there was one.
 
     """
     def __init__(self, callback, *args, **kwargs):
@@ -16,6 +22,8 @@ class InstrumentedSocket(socks.socksocket):
         self._called_back = False
         self._error_count = 0
         self._total_time = 0
+        self._socks5_reply_pending = False
+        self.socks_error = None
         socks.socksocket.__init__(self, *args, **kwargs)
 
     @contextmanager
@@ -48,12 +56,108 @@ class InstrumentedSocket(socks.socksocket):
     def _do_callback(self):
         """ Communicate back socket connection statistics. """
         if not self._called_back:
-            self._callback(self._total_time, self._error_count)
+            self._callback(self._total_time, self._error_count,
+                           self.socks_error)
             self._called_back = True
 
     def connect(self, address):
         with self._timer():
-            return socks.socksocket.connect(self, address)
+            self._connect(address)
+            if self._socks5_reply_pending:
+                self._read_socks5_reply()
+
+    def connect_optimistic(self, address):
+        """ Connect without waiting for the SOCKS5 reply.
+
+        Data sent before complete_connect() is called is passed along by Tor
+        as optimistic data, which saves waiting for the destination to be
+        connected. Other proxy types connect as usual.
+
+        """
+        with self._timer():
+            self._connect(address)
+
+    def complete_connect(self):
+        """ Read the SOCKS5 reply left over by connect_optimistic().
+
+        It must be called before reading from the socket.
+
+        """
+        if self._socks5_reply_pending:
+            with self._timer():
+                self._read_socks5_reply()
+
+    def _connect(self, address):
+        proxy_type, proxy_host, proxy_port = self._socksocket__proxy[:3]
+        if self.family == AF_UNIX:
+            # SocksiPy only knows of TCP proxies, the host is a socket path.
+            proxy_address = proxy_host
+        else:
+            proxy_address = (proxy_host, proxy_port or 1080)
+        if proxy_type == socks.PROXY_TYPE_SOCKS5:
+            socks._orgsocket.connect(self, proxy_address)
+            self._send_socks5_request(*address)
+        elif self.family != AF_UNIX:
+            socks.socksocket.connect(self, address)
+        elif proxy_type == socks.PROXY_TYPE_SOCKS4:
+            socks._orgsocket.connect(self, proxy_address)
+            # Leave the negotiation to a private SocksiPy method.
+            self._socksocket__negotiatesocks4(*address)
+        else:
+            raise socks.GeneralProxyError((4, socks._generalerrors[4]))
+
+    def _send_socks5_request(self, host, port):
+        """ Send the SOCKS5 greeting and CONNECT request at once.
+
+        Only the "no authentication" method is offered, so the request can
+        follow the greeting without waiting for the method selection. IP
+        addresses, including bracketed IPv6 ones, are sent as such and
+        anything else as a domain name.
+
+        """
+        try:
+            address = '\x01' + inet_pton(AF_INET, host)
+        except socket_error:
+            try:
+                address = '\x04' + inet_pton(AF_INET6, host.strip('[]'))
+            except socket_error:
+                address = '\x03' + chr(len(host)) + host
+        socks._orgsocket.sendall(self, '\x05\x01\x00' + '\x05\x01\x00' +
+                                 address + struct.pack('>H', port))
+        self._socks5_reply_pending = True
+
+    def _read_socks5_reply(self):
+        self._socks5_reply_pending = False
+        if self._recvall(2) != '\x05\x00':
+            raise socks.GeneralProxyError((1, socks._generalerrors[1]))
+        version, reply, _, address_type = self._recvall(4)
+        if version != '\x05':
+            raise socks.GeneralProxyError((1, socks._generalerrors[1]))
+        if reply != '\x00':
+            self.socks_error = ord(reply)
+            raise socks.Socks5Error(
+                (self.socks_error,
+                 socks._socks5errors[min(self.socks_error, 9)]))
+        # Skip the bound address and port.
+        if address_type == '\x01':
+            length = 4
+        elif address_type == '\x03':
+            length = ord(self._recvall(1))
+        elif address_type == '\x04':
+            length = 16
+        else:
+            raise socks.GeneralProxyError((1, socks._generalerrors[1]))
+        self._recvall(length + 2)
+
+    def _recvall(self, count):
+        data = ''
+        while len(data) < count:
+            chunk = self.recv(count - len(data))
+            if not chunk:
+                raise socks.GeneralProxyError(
+                    (0, 'connection closed unexpectedly'))
+            data += chunk
+        return data
 
     def connect_ex(self, address):
         with self._timer():
@@ -64,8 +168,9 @@ class InstrumentedSocket(socks.socksocket):
             return socks.socksocket.send(self, *args, **kwargs)
 
     def sendall(self, *args, **kwargs):
+        # Some SocksiPy versions encode() the data, which fails on binary str.
         with self._callback_on_error():
-            return socks.socksocket.sendall(self, *args, **kwargs)
+            return socks._orgsocket.sendall(self, *args, **kwargs)
 
     def sendto(self, *args, **kwargs):
         with self._callback_on_error():
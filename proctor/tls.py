@@ -0,0 +1,177 @@
+""" TLS helpers for intercepted CONNECT requests.
+
+Intercepting HTTPS costs two TLS handshakes per CONNECT: one with the
+destination, and one with the client using a certificate forged for the
+destination host. This module makes both cheaper:
+
+*   UpstreamTLS shares one client context across connections, instead of
+    creating one for each.
+
+*   CertificateCache keeps the forged certificates on disk in the work dir and
+    the corresponding server contexts in memory, and generates the keys of new
+    certificates ahead of time in a background thread.
+
+"""
+from __future__ import absolute_import
+
+import logging
+import os
+import ssl
+from os import path
+from Queue import Queue
+from socket import error as socket_error, inet_aton
+from threading import Lock, Thread
+from time import time
+
+from miproxy.proxy import CertificateAuthority
+from OpenSSL.crypto import (
+    FILETYPE_PEM, TYPE_RSA, X509, X509Extension, PKey, dump_certificate,
+    dump_privatekey)
+
+from proctor.lrucache import LRUCache
+from proctor.profiling import TimedLock
+
+log = logging.getLogger(__name__)
+
+
+class _Timings(object):
+    """ Count events and the time they took, per kind. """
+    def __init__(self, *kinds):
+        self._counts = dict.fromkeys(kinds, 0)
+        self._times = dict.fromkeys(kinds, 0.0)
+        self._lock = Lock()
+
+    def add(self, kind, seconds):
+        with self._lock:
+            self._counts[kind] += 1
+            self._times[kind] += seconds
+
+    def get(self):
+        """ Return a dict of kind: (count, average time). """
+        with self._lock:
+            return dict((kind, (count, self._times[kind] / (count or 1)))
+                        for kind, count in self._counts.iteritems())
+
+
+class UpstreamTLS(object):
+    """ Wraps sockets to destinations in TLS using a shared client context.
+
+    Like ssl.wrap_socket() the destination certificates are not verified.
+
+    """
+    def __init__(self):
+        self.context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        self._timings = _Timings('handshake')
+
+    def wrap(self, sock, hostname):
+        """ Return the socket wrapped in TLS, after the handshake. """
+        start_time = time()
+        ssl_sock = self.context.wrap_socket(sock, server_hostname=hostname)
+        self._timings.add('handshake', time() - start_time)
+        return ssl_sock
+
+    def stats(self):
+        """ Return the handshake count and average time. """
+        return self._timings.get()
+
+
+class KeyPool(Thread):
+    """ Generates RSA keys in the background, ahead of their use. """
+    def __init__(self, size=8, bits=2048):
+        super(KeyPool, self).__init__(name='key-pool')
+        self.daemon = True
+        self.bits = bits
+        self._keys = Queue(size)
+
+    def run(self):
+        while True:
+            self._keys.put(self._generate())
+
+    def _generate(self):
+        key = PKey()
+        key.generate_key(TYPE_RSA, self.bits)
+        return key
+
+    def get(self):
+        """ Return a fresh key, waiting for one to be generated if needed. """
+        return self._keys.get()
+
+
+class CertificateCache(CertificateAuthority):
+    """ A miproxy certificate authority that caches forged certificates.
+
+    Certificates are stored in `cache_dir` and reused across runs when it is
+    persistent, and the server-side TLS contexts of the most recently used
+    hosts are kept in memory.
+
+    """
+    def __init__(self, ca_file, cache_dir, contexts_max=256, key_pool_size=8):
+        if not path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self._generate_lock = TimedLock('certificates')
+        self._contexts = LRUCache(contexts_max)
+        self._timings = _Timings('memory', 'disk', 'generated')
+        self.key_pool = KeyPool(key_pool_size)
+        CertificateAuthority.__init__(self, ca_file, cache_dir)
+        self.key_pool.start()
+
+    def _get_serial(self):
+        # Avoid loading every cached certificate. Serial numbers only need to
+        # be unique, and are incremented by one for each new certificate.
+        return int(time() * 1000)
+
+    def _cert_path(self, cn):
+        return path.join(self.cache_dir, '.pymp_%s.pem' % cn)
+
+    def __getitem__(self, cn):
+        """ Return the path to the certificate file for the host. """
+        if not cn or '/' in cn or cn.startswith('.'):
+            raise ValueError('Invalid host name %r' % cn)
+        cert_path = self._cert_path(cn)
+        if not path.exists(cert_path):
+            with self._generate_lock:
+                if not path.exists(cert_path):
+                    self._generate(cn, cert_path)
+        return cert_path
+
+    def _generate(self, cn, cert_path):
+        key = self.key_pool.get()
+        cert = X509()
+        cert.set_version(2)
+        cert.get_subject().CN = cn
+        cert.set_serial_number(self.serial)
+        cert.gmtime_adj_notBefore(-3600)
+        cert.gmtime_adj_notAfter(31536000)
+        cert.set_issuer(self.cert.get_subject())
+        cert.set_pubkey(key)
+        try:
+            inet_aton(cn)
+            alt_name = 'IP:%s' % cn
+        except socket_error:
+            alt_name = 'DNS:%s' % cn
+        cert.add_extensions([X509Extension('subjectAltName', False, alt_name)])
+        cert.sign(self.key, 'sha256')
+        # Written aside then renamed, so that no reader sees a partial file.
+        tmp_path = '%s.%d.tmp' % (cert_path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(dump_privatekey(FILETYPE_PEM, key))
+            f.write(dump_certificate(FILETYPE_PEM, cert))
+        os.rename(tmp_path, cert_path)
+
+    def context(self, cn):
+        """ Return a server-side SSLContext with a certificate for cn. """
+        start_time = time()
+        context = self._contexts.get(cn)
+        if context is not None:
+            self._timings.add('memory', time() - start_time)
+            return context
+        kind = 'disk' if path.exists(self._cert_path(cn)) else 'generated'
+        context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        context.load_cert_chain(self[cn])
+        self._contexts.put(cn, context)
+        self._timings.add(kind, time() - start_time)
+        return context
+
+    def stats(self):
+        """ Return lookup counts and average times per cache level. """
+        return self._timings.get()
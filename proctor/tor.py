@@ -1,17 +1,28 @@
+from __future__ import absolute_import
+
+from collections import Counter
 from datetime import datetime
-from itertools import chain, cycle
+from itertools import chain
 from os import path
+from socket import AF_UNIX
 from threading import Event, Lock, Thread
 from time import sleep
 
 import socks
 from desub import desub
 
+from proctor.health import RestartPolicy
+from proctor.profiling import TimedLock
 from proctor.socket import InstrumentedSocket
 
 import logging
 log = logging.getLogger(__name__)
 
+# SOCKS5 error replies caused by the destination rather than by the circuit
+# (rejected by the exit policy, unresolvable host, connection refused), which
+# do not count against the health of a Tor instance.
+DESTINATION_SOCKS5_ERRORS = (2, 4, 5)
+
 
 class TorProcess(Thread):
     """ Runs and manages a Tor process in a thread.
@@ -20,10 +31,31 @@ class TorProcess(Thread):
     monitoring connection times and the error rate and restarting the process
     when unhealthy.
 
+    When given a DirectoryCache, the data directory is seeded from it before
+    each start, and the cache is kept up to date with the documents fetched
+    by the process.
+
+    With `unix_sockets`, the SOCKS and control ports are Unix domain sockets
+    in the work dir instead of TCP ports, and the port numbers are unused.
+
+    Sockets talk SOCKS5 to Tor unless `socks5` is False, which lets them send
+    data before the destination is connected, and reports failures with
+    precise error codes. Their counts are available from get_socks_errors().
+
+    What happens to unhealthy instances is decided by a policy created with
+    `health_policy` (proctor.health.RestartPolicy by default).
+
+    Time is read from `clock`, which proctor.simulator replaces with a virtual
+    clock.
+
     """
+    clock = staticmethod(datetime.utcnow)
+
     def __init__(self, name, socks_port, control_port, base_work_dir,
                  boot_time_max=30, errors_max=10, conn_time_avg_max=2,
-                 grace_time=30, sockets_max=None, resurrections_max=10):
+                 grace_time=30, sockets_max=None, resurrections_max=10,
+                 dir_cache=None, dir_cache_interval=600, unix_sockets=False,
+                 socks5=True, stats_window=200, health_policy=None):
         super(TorProcess, self).__init__()
         self.name = name
         self.socks_port = socks_port
@@ -35,22 +67,35 @@ class TorProcess(Thread):
         self.grace_time = grace_time
         self.sockets_max = sockets_max
         self.resurrections_max = resurrections_max
+        self.dir_cache = dir_cache
+        self.dir_cache_interval = dir_cache_interval
+        self.unix_sockets = unix_sockets
+        self.socks5 = socks5
+        self.boot_duration = None
         self._connected = Event()
-        self._exclusive_access = Lock()
+        self._exclusive_access = TimedLock('%s.exclusive_access' % name)
         self._ref_count = 0
         self._ref_count_lock = Lock()
         self._socket_count = 0
         self._socket_count_lock = Lock()
-        self._stats_lock = Lock()
-        self._stats_window = 200
+        self._stats_lock = TimedLock('%s.stats' % name)
+        self._stats_window = stats_window
         self._stoprequest = Event()
         self._terminated = False
+        self.bind_failed = False
+        self.draining = False
+        self.health = (health_policy or RestartPolicy)(self)
 
     def run(self):
         """ Run and supervise the Tor process. """
+        if self.unix_sockets:
+            control_port = 'unix:' + self.control_path
+            socks_port = 'unix:' + self.socks_path
+        else:
+            control_port, socks_port = self.control_port, self.socks_port
         args = dict(CookieAuthentication=0, HashedControlPassword='',
-                    ControlPort=self.control_port, PidFile=self.pid_file,
-                    SocksPort=self.socks_port, DataDirectory=self.work_dir)
+                    ControlPort=control_port, PidFile=self.pid_file,
+                    SocksPort=socks_port, DataDirectory=self.work_dir)
         args = map(str, chain(*(('--' + k, v) for k, v in args.iteritems())))
         tor = desub.join(['tor'] + args)
         self._start(tor)
@@ -77,35 +122,47 @@ class TorProcess(Thread):
                 log.debug('Stopped %s' % self.name)
             # Check health and restart when appropriate.
             elif self._connected.is_set():
-                errors, timing_avg, samples = self.get_stats()
-                too_many_errors = errors > self.errors_max
-                too_slow = timing_avg > self.conn_time_avg_max
-                max_use_reached = (self.sockets_max
-                                   and self._socket_count >= self.sockets_max)
-                needs_restart = too_many_errors or too_slow or max_use_reached
-                if self.age > self.grace_time and needs_restart:
+                if self.check_health() is not None:
                     self._restart(tor)
+                elif self.dir_cache is not None and (
+                        self.clock() - self._dir_cache_time
+                        ).total_seconds() > self.dir_cache_interval:
+                    self._update_dir_cache()
             else:
                 out = tor.stdout.read()
                 # Check for successful connection.
                 if 'Bootstrapped 100%: Done.' in out:
                     self._connected.set()
-                    log.info('%s is connected' % self.name)
-                    self._start_time = datetime.utcnow()
+                    self.boot_duration = self.time_since_boot
+                    log.info('%s is connected (bootstrapped in %.1fs%s)'
+                             % (self.name, self.boot_duration,
+                                ', seeded' if self._seeded else ''))
+                    self._start_time = self.clock()
+                    if self.dir_cache is not None:
+                        self._update_dir_cache()
                 else:
                     # Check if initialization takes too long.
                     if self.time_since_boot > self.boot_time_max:
                         self._restart(tor, failed_boot=True)
                     # Check for socket binding failures.
-                    else:
+                    elif not self.unix_sockets:
                         for port in [self.socks_port, self.control_port]:
                             if 'Could not bind to 127.0.0.1:%s' % port in out:
                                 error = ('Could not bind %s to 127.0.0.1:%s'
                                         % (self.name, port))
                                 log.warn(error)
+                                self.bind_failed = True
                                 self._terminated = True
                                 break
 
+    def check_health(self):
+        """ Return why the Tor process should be restarted, or None.
+
+        Called every second once the process is connected.
+
+        """
+        return self.health.check()
+
     def stop(self):
         """ Signal the thread to stop itself. """
         self._stoprequest.set()
@@ -118,6 +175,14 @@ class TorProcess(Thread):
     def pid_file(self):
         return path.join(self.work_dir, 'pid')
 
+    @property
+    def socks_path(self):
+        return path.join(self.work_dir, 'socks.sock')
+
+    @property
+    def control_path(self):
+        return path.join(self.work_dir, 'control.sock')
+
     @property
     def connected(self):
         return self._connected.is_set()
@@ -125,26 +190,59 @@ class TorProcess(Thread):
     @property
     def age(self):
         """ Return the number of seconds since the Tor circuit is usable. """
-        return (datetime.utcnow() - self._start_time).total_seconds()
+        return (self.clock() - self._start_time).total_seconds()
 
     @property
     def terminated(self):
         return self._terminated
 
+    @property
+    def available(self):
+        """ Tell whether the instance may take new requests right now. """
+        return self.connected and not self.health.blocked
+
+    @property
+    def socket_count(self):
+        """ Return the number of sockets created since the last start. """
+        return self._socket_count
+
+    @property
+    def active_sockets(self):
+        """ Return the number of sockets currently using this instance. """
+        return self._ref_count
+
     @property
     def time_since_boot(self):
         """ Return the number of seconds since the last Tor process start. """
-        return (datetime.utcnow() - self._boot_time).total_seconds()
+        return (self.clock() - self._boot_time).total_seconds()
 
     def _start(self, tor):
         """ Start a Tor process. """
         with self._stats_lock:
-            self._boot_time = datetime.utcnow()
+            self._boot_time = self.clock()
             self._socket_count = 0
             self._stats_errors = list()
             self._stats_timing = list()
+            self._socks_errors = Counter()
+        self.health.reset()
+        self._seeded = False
+        if self.dir_cache is not None:
+            try:
+                self._seeded = self.dir_cache.seed(self.work_dir)
+            except (IOError, OSError), e:
+                log.warn('Could not seed %s from the directory cache: %s'
+                         % (self.name, e))
         tor.start()
 
+    def _update_dir_cache(self):
+        """ Share the directory documents of the process. """
+        self._dir_cache_time = self.clock()
+        try:
+            self.dir_cache.update(self.work_dir)
+        except (IOError, OSError), e:
+            log.warn('Could not update the directory cache from %s: %s'
+                     % (self.name, e))
+
     def _restart(self, tor, failed_boot=False, died=False):
         """ Safely replace a Tor instance with a fresh one. """
         with self._exclusive_access:  # Prevent creating sockets.
@@ -165,10 +263,10 @@ class TorProcess(Thread):
                 log.warn('Resurrected %s' % self.name)
             else:
                 errors, timing_avg, samples = self.get_stats()
-                log.warn(('Restarting %s '
-                          '(errors: %s, avg time: %s, count: %s, age: %s)')
+                log.warn(('Restarting %s (errors: %s, avg time: %s, '
+                          'count: %s, age: %s, SOCKS errors: %s)')
                          % (self.name, errors, timing_avg, self._socket_count,
-                            int(self.age)))
+                            int(self.age), self.get_socks_errors()))
             tor.stop()
             self._start(tor)
 
@@ -187,9 +285,13 @@ class TorProcess(Thread):
         with self._ref_count_lock:
             self._ref_count -= 1
 
-    def _receive_stats(self, timing, errors):
+    def _receive_stats(self, timing, errors, socks_error=None):
         """ Maintain connection statistics over time. """
         with self._stats_lock:
+            if socks_error is not None:
+                self._socks_errors[socks_error] += 1
+                if socks_error in DESTINATION_SOCKS5_ERRORS:
+                    errors = max(errors - 1, 0)
             self._stats_errors.append(errors)
             self._stats_timing.append(timing)
             if len(self._stats_errors) > self._stats_window:
@@ -197,6 +299,13 @@ class TorProcess(Thread):
                 self._stats_timing = self._stats_timing[-self._stats_window:]
             # We consider the socket at end of life when it sends the stats.
             self._dec_ref_count()
+        self.health.on_result(timing, errors)
+
+    def reset_stats(self):
+        """ Forget the connection times and errors measured so far. """
+        with self._stats_lock:
+            self._stats_errors = list()
+            self._stats_timing = list()
 
     def get_stats(self):
         """ Return current statistics. """
@@ -206,15 +315,34 @@ class TorProcess(Thread):
             timing_avg = sum(self._stats_timing) / (samples or 1)
             return errors, timing_avg, samples
 
+    def get_socks_errors(self):
+        """ Return a dict of SOCKS5 error messages and their counts.
+
+        Counts cover the current Tor process, like get_stats().
+
+        """
+        with self._stats_lock:
+            return dict((socks._socks5errors[min(code, 9)], count)
+                        for code, count in self._socks_errors.iteritems())
+
     def create_socket(self, suppress_errors=False, *args, **kwargs):
         """ Return an InstrumentedSocket that will connect through Tor. """
         if self.connected:
             if not self._exclusive_access.acquire(False):
                 return None
             try:
-                sock = InstrumentedSocket(self._receive_stats, *args, **kwargs)
-                args = (socks.PROXY_TYPE_SOCKS4, 'localhost', self.socks_port,
-                        True, None, None)  # rdns, username, password
+                if self.unix_sockets:
+                    sock = InstrumentedSocket(self._receive_stats, AF_UNIX,
+                                              *args, **kwargs)
+                    address = self.socks_path
+                else:
+                    sock = InstrumentedSocket(self._receive_stats,
+                                              *args, **kwargs)
+                    address = 'localhost'
+                proxy_type = (socks.PROXY_TYPE_SOCKS5 if self.socks5
+                              else socks.PROXY_TYPE_SOCKS4)
+                args = (proxy_type, address, self.socks_port, True, None,
+                        None)  # rdns, username, password
                 sock.setproxy(*args)
                 # Keep track of how many sockets are using this Tor instance.
                 self._inc_ref_count()
@@ -231,7 +359,19 @@ class TorProcess(Thread):
 
 
 class TorSwarm(object):
-    """ Manages a number of Tor processes. """
+    """ Manages a number of Tor processes.
+
+    Instances can be added and removed while the swarm is running. Each one
+    gets a slot number, which determines its name and ports; slots are
+    reused once their instance is gone, except when the instance failed to
+    bind its ports.
+
+    Instances are created from `process_class` with the keyword arguments
+    given to the swarm.
+
+    """
+    process_class = TorProcess
+
     def __init__(self, base_socks_port, base_control_port, work_dir,
                  sockets_max, **kwargs):
         self.base_socks_port = base_socks_port
@@ -240,32 +380,96 @@ class TorSwarm(object):
         self.sockets_max = sockets_max
         self.kwargs = kwargs
         self._instances = list()
+        self._lock = TimedLock('swarm')
+        self._slots = set()  # In use, or unusable.
 
     def instances(self):
-        """ Return an infinite generator cycling through Tor instances. """
-        for instance in cycle(self._instances):
-            if instance.terminated:
-                alive = list(i for i in self._instances if not i.terminated)
-                if len(alive) == 0:
-                    log.critical('No alive Tor instance left. Bailing out.')
-                    return
-            yield instance
+        """ Return an infinite generator cycling through Tor instances.
+
+        Instances that are being removed are skipped. It goes on when no
+        instance is left alive, as new ones may be added to the swarm, and
+        yields None after a round without any instance: it never blocks, so
+        that callers may back off as they see fit.
+
+        """
+        alive = True
+        while True:
+            instances = self.members()
+            if [i for i in instances if not i.terminated]:
+                alive = True
+            elif alive:
+                alive = False
+                log.critical('No alive Tor instance left, waiting for new '
+                             'ones.')
+            yielded = False
+            for instance in instances:
+                if not instance.draining:
+                    yielded = True
+                    yield instance
+            if not yielded:
+                yield None
+
+    def members(self):
+        """ Return a list of the current Tor instances. """
+        with self._lock:
+            return list(self._instances)
 
     def start(self, num_instances):
         """ Start and return the Tor processes. """
         log.info('Starting Tor swarm with %d instances...' % num_instances)
-        self._instances = list()
         for i in range(num_instances):
-            tor = TorProcess('tor-%d' % i, self.base_socks_port + i,
-                            self.base_control_port + i, self.work_dir,
-                            sockets_max=self.sockets_max, **self.kwargs)
-            self._instances.append(tor)
-            tor.start()
+            self.add_instance()
             sleep(0.1)
-        return self._instances
+        return self.members()
+
+    def add_instance(self):
+        """ Start a new Tor process in the first free slot and return it. """
+        with self._lock:
+            slot = 0
+            while slot in self._slots:
+                slot += 1
+            self._slots.add(slot)
+            tor = self.process_class(
+                'tor-%d' % slot, self.base_socks_port + slot,
+                self.base_control_port + slot, self.work_dir,
+                sockets_max=self.sockets_max, **self.kwargs)
+            tor.slot = slot
+            self._instances.append(tor)
+        tor.start()
+        return tor
+
+    def remove_instance(self, tor, drain_time_max=60):
+        """ Stop sending requests to a Tor process, and stop it once idle.
+
+        The process is stopped in the background, after its sockets are all
+        closed or drain_time_max seconds have passed.
+
+        """
+        tor.draining = True
+        thread = Thread(target=self._retire, args=(tor, drain_time_max))
+        thread.daemon = True
+        thread.start()
+
+    def _retire(self, tor, drain_time_max):
+        drain_start = datetime.utcnow()
+        while tor.active_sockets > 0:
+            if (datetime.utcnow() - drain_start).total_seconds() \
+                    > drain_time_max:
+                log.warn('%s still has %d sockets open, stopping anyway'
+                         % (tor.name, tor.active_sockets))
+                break
+            sleep(0.5)
+        tor.stop()
+        tor.join()
+        with self._lock:
+            self._instances.remove(tor)
+            # Ports that could not be bound are likely used by someone else.
+            if not tor.bind_failed:
+                self._slots.discard(tor.slot)
+        log.info('Removed %s' % tor.name)
 
     def stop(self):
         """ Stop the Tor processes and wait for their completion. """
-        for tor in self._instances:
+        for tor in self.members():
             tor.stop()
             tor.join()
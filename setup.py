@@ -23,7 +23,7 @@ setup(name='proctor',
       maintainer_email=proctor.__email__,
       url=proctor.__url__,
       long_description=read('README.md'),
-      packages=find_packages(),
+      packages=find_packages(exclude=['tests']),
       include_package_data=True,
       install_requires=['desub', 'pymiproxy', 'SocksiPy-branch'],
       classifiers=[
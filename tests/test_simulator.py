@@ -0,0 +1,61 @@
+""" Regression tests of the health policies, on simulated swarms.
+
+Simulations are deterministic for a given seed, but the tests only check
+properties of their results, so that tuning the health logic does not
+break them as long as the policies keep behaving sensibly. Run them with:
+
+    python -m unittest discover tests
+
+"""
+import unittest
+
+from proctor.simulator import (
+    CircuitBreaker, RestartPolicy, Simulation, SyntheticTrace)
+
+INSTANCES = 4
+RATE = 20
+DURATION = 600
+SEEDS = range(3)
+
+
+def simulate(policy, seed=0):
+    return Simulation(SyntheticTrace(), instances=INSTANCES, rate=RATE,
+                      duration=DURATION, seed=seed,
+                      health_policy=policy).run()
+
+
+class SimulationTest(unittest.TestCase):
+    """ Ten simulated minutes of 4 instances under 20 requests per second. """
+    @classmethod
+    def setUpClass(cls):
+        cls.results = dict(
+            ((policy, seed), simulate(policy, seed))
+            for policy in (RestartPolicy, CircuitBreaker) for seed in SEEDS)
+
+    def test_deterministic(self):
+        self.assertEqual(simulate(CircuitBreaker, seed=1),
+                         self.results[CircuitBreaker, 1])
+
+    def test_counts_within_bounds(self):
+        requests = RATE * DURATION
+        for results in self.results.itervalues():
+            restarts = sum(results['restarts'].itervalues())
+            self.assertEqual(results['boots'], INSTANCES + restarts)
+            self.assertLess(restarts, INSTANCES * 3)
+            self.assertLessEqual(results['completed'] + results['failed'],
+                                 requests * 1.1)
+            self.assertLess(results['failed'], requests * 0.1)
+            self.assertGreater(results['throughput'], RATE * 0.9)
+            self.assertLessEqual(results['p50'], results['p90'])
+            self.assertLessEqual(results['p90'], results['p99'])
+            self.assertLess(results['p99'], 30)
+
+    def test_circuit_breaker_restarts_less(self):
+        for seed in SEEDS:
+            self.assertLess(
+                sum(self.results[CircuitBreaker, seed]['restarts'].values()),
+                sum(self.results[RestartPolicy, seed]['restarts'].values()))
+
+
+if __name__ == '__main__':
+    unittest.main()